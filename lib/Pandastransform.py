@@ -1,14 +1,45 @@
 import pandas as pd
 import re
-import os
 import openpyxl
+from lib.anchor import CUTOFF_LAST_ROW, Anchor, locate, titled_cols, cut_at_last
+from lib import instrument
+from lib.reader import read_report_region
+from lib.report import FolderReport
+from lib.schema import apply_schema
 from lib.transform import CreateTableInSQLServer
 
 
-class WIPARRecon:
+@instrument.timed("read")
+def read_region(file_path, keep_cols, first_row, sidecars=None):
+    # Only the columns to keep from first_row down, with pandas' own column and
+    # row selection (the layout comes from lib.reader.peek_sheet). A
+    # lib.sidecar.SheetSidecars copy holds the same text, read it from there.
+    if sidecars is not None:
+        return read_report_region(
+            file_path, keep_cols, first_row, fill="", sidecars=sidecars
+        )
+    df = pd.read_excel(
+        file_path,
+        sheet_name=1,
+        header=None,
+        usecols=sorted(set(keep_cols)),
+        skiprows=first_row,
+        dtype="string[pyarrow]",
+        keep_default_na=False,
+    )
+    return df[keep_cols]
+
+
+class WIPARRecon(FolderReport):
+
+    parser_version = 3
+    # Output column types (lib.schema), every other column is a number
+    schema = {"ClientIdSubId": "category"}
 
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+    layout_markers = [
+        Anchor("header", "WIP Beg\nBalance"),
+        Anchor("cutoff", "For Accounting period dates:", how="prefix"),
+    ]
 
     def find_date(self, txt):
         dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
@@ -18,90 +49,90 @@ class WIPARRecon:
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z]", "", col_name)
 
-    def process_files(self):
-        # List to store DataFrames
-        df_list = []
-
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
-        ]
-        # From here to process each file: This code will be determine what position of special cell in this firm
-        file_path = os.path.join(self.folder_path, xlsx_files[0])
-        df = pd.read_excel(file_path, sheet_name=1)
-        df = df.astype(str)
-
-        # Find row contains header
-        found = False
-        for row in df.index:
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx] == "WIP Beg\nBalance":
-                        row_header = row
-                        found = True
-                        break
-            if found:
-                break
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        anchors = locate(
+            df,
+            [
+                # Find row contains header
+                Anchor("header", "WIP Beg\nBalance"),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor(
+                    "cutoff",
+                    "For Accounting period dates:",
+                    how="prefix",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+            ],
+        )
+        row_header, _ = anchors["header"]
+        row_cutoff, col_cutoff = anchors["cutoff"]
         # Determine cols name to keep
-        keep_cols = []
-        for col_idx in range(df.shape[1]):
-            if df.iloc[row_header, col_idx] != "nan":
-                keep_cols.append(col_idx)
-        # Determine CutOffDate
-        found = False
-
-        for row in range(16):  # Because this cell always before 16 rows
-            for col in df.columns:
-                if df.at[row, col] and isinstance(df.at[row, col], str):
-                    if df.at[row, col][:28] == "For Accounting period dates:":
-                        # CutOffDate = self.find_date(df.at[row, col])
-                        row_cutoff, col_cutoff = row, col
-                        found = True
-                        break  # Break the inner loop
-            if found:
-                break
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            df = pd.read_excel(file_path, sheet_name=1)
-            df["CutOffDate"] = self.find_date(df.at[row_cutoff, col_cutoff])
-            df = df.astype(str)
-            df = df.iloc[:, keep_cols]
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-            df = df.drop(df.index[: row_header + 1]).reset_index(drop=True)
-            df["ClientIdSubId"] = df["WIPBegBalance"]
-            # Exclude rows has "Grand Total" to the end
-            for row in reversed(df.index):
-                if df.iloc[row, 0] == "Grand Totals":
-                    df.drop(df.index[row:], inplace=True)
-                    break
-            for row in df.index:
-                if len(df.at[row, "ClientIdSubId"].split(" ")) == 6:
-                    df.at[row, "ClientIdSubId"] = df.at[row, "ClientIdSubId"].split(
-                        " "
-                    )[5]
-                else:
-                    df.at[row, "ClientIdSubId"] = df.at[row - 1, "ClientIdSubId"]
-            df = df[df["Hours"] != "nan"]
-            df["RealPercent"] = df["RealPercent"].replace("%", "", regex=True)
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-        
-        for i in final_df.columns:
-            if i != "ClientIdSubId":
-                final_df[i] = pd.to_numeric(final_df[i], errors="coerce")
-        return final_df
-
+        keep_cols = titled_cols(df, row_header, blanks=("",))
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path, fill="")
+        df = read_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
+        ]
+        df = df.drop(df.index[:1]).reset_index(drop=True)
+        df["ClientIdSubId"] = df["WIPBegBalance"]
+        # Exclude rows has "Grand Total" to the end
+        df = cut_at_last(df, "Grand Totals")
+        # Client rows have exactly 6 words, the last one is the id, every other
+        # row belongs to the client above it
+        df["ClientIdSubId"] = (
+            df["ClientIdSubId"].str.extract(r"^(?:[^ ]* ){5}([^ ]*)$")[0].ffill()
+        )
+        df = df[df["Hours"] != ""]
+        df["RealPercent"] = df["RealPercent"].replace("%", "", regex=True)
+        return df
+
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
 
-class WIPARAging:
 
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+class WIPARAging(FolderReport):
+
+    parser_version = 4
+    # Every other column is a number
+    schema = {
+        "ClientIdSubId": "category",
+        # AR/WIP of the parsed files, pivoted into the columns by finalize
+        "Type": "category",
+        "LastPaymentDate": "text",
+        "LastPaymentAmount": "text",
+        "CutOffDate": "text",
+    }
+
+    # First date and first $ amount anywhere in a "Last Payment" cell, as
+    # groups 0 and 1 of one str.extract
+    last_payment = re.compile(
+        r"(?s)^(?=(?:.*?(\d{1,2}/\d{1,2}/\d{4}))?)"
+        r"(?=(?:.*?\$(\d{1,3}(?:,\d{3})*(?:\.\d{2})?))?)"
+    )
+
+    layout_markers = [
+        Anchor("header", "Total"),
+        Anchor("client", "Client ID Sub ID :", how="prefix"),
+        Anchor("type", "AR"),
+        Anchor("cutoff", "For WIP dates as of:", how="prefix"),
+    ]
 
     def find_date(self, txt):
         dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
@@ -111,159 +142,103 @@ class WIPARAging:
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z0-9]", "", col_name)
 
-    def get_payment(self, txt):
-        date_match = re.search(r"\d{1,2}/\d{1,2}/\d{4}", txt)
-        amount_match = re.search(r"\$\d{1,3}(?:,\d{3})*(?:\.\d{2})?", txt)
-        LastPaymentDate = date = date_match.group() if date_match else "1/1/1900"
-        LastPaymentAmount = (
-            amount_match.group().replace("$", "").replace(",", "")
-            if amount_match
-            else 0
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        # Find row contains header
+        row_header, _ = locate(df, [Anchor("header", "Total")])["header"]
+        anchors = locate(
+            df,
+            [
+                # Keep ClientIdSubId column
+                Anchor(
+                    "client", "Client ID Sub ID :", how="prefix", first_row=row_header
+                ),
+                # Keep type of transaction column
+                Anchor("type", "AR", first_row=row_header),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor(
+                    "cutoff",
+                    "For WIP dates as of:",
+                    how="prefix",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+            ],
         )
-        return LastPaymentDate, LastPaymentAmount
-
-    def process_files(self):
-        # List to store DataFrames
-        df_list = []
-
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
+        # List all cols name to keep, all column has title
+        keep_cols = [anchors["client"][1], anchors["type"][1]] + titled_cols(
+            df, row_header, blanks=("",)
+        )
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path, fill="")
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        df = read_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
         ]
-        # From here to process each file: This code will be determine what position of special cell in this firm
-        file_path = os.path.join(self.folder_path, xlsx_files[0])
-        df = pd.read_excel(file_path, sheet_name=1)
-        df = df.astype(str)
-
-        # Find row contains header
-        found = False
-        for row in df.index:
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx] == "Total":
-                        row_header = row
-                        found = True
-                        break
-            if found:
-                break
-        # List all cols name to keep
-        # Keep ClientIdSubId column
-        keep_cols = []
-        found = False
-        for row in range(row_header, df.shape[0]):
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx][:18] == "Client ID Sub ID :":
-                        keep_cols.append(col_idx)
-                        found = True
-                        break
-            if found:
-                break
-        # Keep type of transaction column
-        found = False
-        for row in range(row_header, df.shape[0]):
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx][:18] == "AR":
-                        keep_cols.append(col_idx)
-                        found = True
-                        break
-            if found:
-                break
-        # Keep all column has title
-        for col_idx in range(df.shape[1]):
-            if df.iloc[row_header, col_idx] != "nan":
-                keep_cols.append(col_idx)
-
-        # Determine CutOffDate
-        found = False
-        for row in range(16):  # Because this cell always before 16 rows
-            for col in df.columns:
-                if df.at[row, col] and isinstance(df.at[row, col], str):
-                    if df.at[row, col][:20] == "For WIP dates as of:":
-
-                        row_cutoff, col_cutoff = row, col
-                        found = True
-                        break  # Break the inner loop
-            if found:
-                break
-
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            df = pd.read_excel(file_path, sheet_name=1)
-            CutOffDate = self.find_date(df.at[row_cutoff, col_cutoff])
-            df = df.astype(str)
-            df = df.iloc[:, keep_cols]
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-            df.columns.values[0] = "LastPaymentDate"
-            df.columns.values[1] = "Type"
-            df["ClientIdSubId"] = df["LastPaymentDate"]
-            df["LastPaymentAmount"] = df["LastPaymentDate"]
-            df = df.drop(df.index[: row_header + 1]).reset_index(drop=True)
-            # Exclude rows has "Grand Total" to the end
-            for row in reversed(df.index):
-                if df.iloc[row, 0] == "Grand Totals :":
-                    df.drop(df.index[row:], inplace=True)
-                    break
-            # Find Step:
-            Step_For = None
-            for row in range(1, df.shape[0]):  # Find from second row
-                if df.at[row, "ClientIdSubId"][:3] == "Cli":
-                    Step_For = row
-                    break
-            # Fill down ClientIdSubId
-            for row in range(0, df.shape[0], Step_For):
-                if df.at[row, "ClientIdSubId"][:3] == "Cli":
-                    df.at[row, "ClientIdSubId"] = df.at[row, "ClientIdSubId"].split(
-                        " "
-                    )[5]
-                    for i in range(1, Step_For):
-                        df.at[row + i, "ClientIdSubId"] = df.at[row, "ClientIdSubId"]
-            # Filter Out Type = nan
-            df = df[df["Type"] != "nan"]
-            # Fill down LastPaymentDate
-            for row in df.index:
-                if df.at[row, "LastPaymentDate"][:3] == "Las":
-                    df.at[row, "LastPaymentDate"] = self.get_payment(
-                        df.at[row, "LastPaymentDate"]
-                    )[0]
-                    df.at[row + 1, "LastPaymentDate"] = df.at[row, "LastPaymentDate"]
-                    df.at[row, "LastPaymentAmount"] = self.get_payment(
-                        df.at[row, "LastPaymentAmount"]
-                    )[1]
-                    df.at[row + 1, "LastPaymentAmount"] = df.at[
-                        row, "LastPaymentAmount"
-                    ]
-            df = df.pivot(index="ClientIdSubId", columns="Type")
-            df = df.reset_index()
-            df.columns = [
-                f"{col[0]}_{col[1]}" if col[1] != "" else col[0] for col in df.columns
-            ]
-            df.drop(
-                columns=["LastPaymentDate_AR", "LastPaymentAmount_AR"], inplace=True
-            )
-            df.rename(
-                columns={
-                    "LastPaymentAmount_WIP": "LastPaymentAmount",
-                    "LastPaymentDate_WIP": "LastPaymentDate",
-                },
-                inplace=True,
+        df.columns.values[0] = "LastPaymentDate"
+        df.columns.values[1] = "Type"
+        df["ClientIdSubId"] = df["LastPaymentDate"]
+        df["LastPaymentAmount"] = df["LastPaymentDate"]
+        df = df.drop(df.index[:1]).reset_index(drop=True)
+        # Exclude rows has "Grand Total" to the end
+        df = cut_at_last(df, "Grand Totals :")
+        # Fill down ClientIdSubId: id from the "Client ..." row of each block,
+        # blocks can have any number of rows
+        client_rows = df["ClientIdSubId"].str.startswith("Cli", na=False)
+        df["ClientIdSubId"] = (
+            df["ClientIdSubId"]
+            .where(client_rows)
+            .str.extract(r"^(?:[^ ]* ){5}([^ ]*)")[0]
+            .ffill()
+        )
+        # Filter Out empty Type
+        df = df[df["Type"] != ""]
+        # Payment date and amount of the "Last Payment" rows
+        paid = df["LastPaymentDate"].str.startswith("Las")
+        payment = df.loc[paid, "LastPaymentDate"].str.extract(self.last_payment)
+        payment[0] = payment[0].fillna("1/1/1900")
+        payment[1] = payment[1].str.replace(",", "", regex=False).fillna("0")
+        # Fill down to the row below (the AR row of the same client)
+        below = payment.set_axis(payment.index + 1)
+        for i, col in enumerate(["LastPaymentDate", "LastPaymentAmount"]):
+            df[col] = (
+                payment[i].combine_first(below[i]).reindex(df.index).fillna(df[col])
             )
-            df["CutOffDate"] = CutOffDate
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-        for i in final_df.columns:
-            if i not in [
-                "ClientIdSubId",
-                "LastPaymentAmount",
-                "LastPaymentDate",
-                "CutOffDate",
-            ]:
-                final_df[i] = pd.to_numeric(final_df[i], errors="coerce")
-        return final_df
+        df["CutOffDate"] = CutOffDate
+        return df
+
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        # AR and WIP rows of a client side by side, in one reshape
+        final_df = final_df.pivot(index=["ClientIdSubId", "CutOffDate"], columns="Type")
+        final_df.columns = [f"{col[0]}_{col[1]}" for col in final_df.columns]
+        final_df = final_df.reset_index()
+        final_df.drop(
+            columns=["LastPaymentDate_AR", "LastPaymentAmount_AR"], inplace=True
+        )
+        final_df.rename(
+            columns={
+                "LastPaymentAmount_WIP": "LastPaymentAmount",
+                "LastPaymentDate_WIP": "LastPaymentDate",
+            },
+            inplace=True,
+        )
+        # CutOffDate last as before
+        final_df["CutOffDate"] = final_df.pop("CutOffDate")
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
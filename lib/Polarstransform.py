@@ -0,0 +1,439 @@
+import polars as pl
+import re
+from datetime import datetime
+from lib.anchor import CUTOFF_LAST_ROW, Anchor, locate, titled_cols
+from lib import instrument, transform
+from lib.reader import read_sheet_region
+from lib.report import FolderReport
+from lib.schema import apply_schema
+
+# Polars versions of the reports. The layout comes from the top rows of the
+# sheet (lib.reader.peek_sheet, lib.layout), then only the columns to keep are
+# read from the header row down, as text (the same cell text as lib.transform,
+# but empty cells stay null), and each file is one lazy query. process_files
+# returns a polars DataFrame with the same content as lib.transform,
+# lib.loader.SQLLoader converts it when it is written.
+
+
+def select_cols(df, names):
+    # Region columns renamed from the header row, plus the row position
+    return df.lazy().select(
+        pl.int_range(pl.len()).alias("row"),
+        *[pl.col(col).alias(name) for col, name in zip(df.columns, names)],
+    )
+
+
+def before_last(col, value):
+    # Rows above the last `value` row (e.g. "Grand Totals"), all rows if none
+    last = pl.col("row").filter(pl.col(col) == value).max()
+    return pl.col("row") < last.fill_null(pl.len())
+
+
+class ARBalanceListing(FolderReport):
+
+    parser_version = 2
+    key_cols = None
+    period_col = None
+    # Same output types as lib.transform
+    schema = transform.ARBalanceListing.schema
+    layout_markers = transform.ARBalanceListing.layout_markers
+
+    def clean_column_name(self, col_name):
+        return re.sub(r"[^a-zA-Z0-9]", "", col_name)
+
+    def detect_layout(self, df):
+        # Find row contains header
+        row_header, _ = locate(df, [Anchor("header", "Client ID")])["header"]
+        # List all cols name to keep
+        keep_cols = titled_cols(df, row_header, blanks=(None,))
+        return {"row_header": row_header, "keep_cols": keep_cols}
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path)
+        df = read_sheet_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        names = [self.clean_column_name(title) for title in df.row(0)]
+
+        return (
+            select_cols(df, names)
+            .filter(
+                (
+                    pl.col("ClientID").is_not_null()
+                    | pl.col("TransactionDate").is_not_null()
+                )
+                & (pl.col("ClientID") != "Client ID").fill_null(True)
+                & (pl.col("ClientID") != "Grand totals:").fill_null(True)
+            )
+            .with_columns(
+                pl.when(pl.col(name) != "").then(pl.col(name)).alias(name)
+                for name in names
+            )
+            .with_columns(
+                pl.col("ClientID").forward_fill().str.extract(r"^\s*(?:\S+\s+){4}(\S+)")
+            )
+            .filter(pl.col("TransactionDate").is_not_null())
+            .drop("row", "ClientName", "ARBalance", "AccountingPeriodDate")
+            .rename(
+                {
+                    "ClientID": "ClientIdSubId",
+                    "Document": "TransNumber",
+                    "AppliedTo": "AppliedNumber",
+                }
+            )
+            # Text dates or the text of date cells
+            .with_columns(
+                pl.coalesce(
+                    pl.col("TransactionDate").str.to_datetime(
+                        "%m/%d/%Y", time_unit="ns", strict=False
+                    ),
+                    pl.col("TransactionDate").str.to_datetime(
+                        "%Y-%m-%d %H:%M:%S", time_unit="ns", strict=False
+                    ),
+                )
+            )
+            .collect()
+        )
+
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        return apply_schema(
+            final_df, self.schema, errors="raise", categories=categories
+        )
+
+
+class WIPActivity(FolderReport):
+
+    parser_version = 2
+    key_cols = ["ClientIdSubId", "CutOffDate"]
+    period_col = "CutOffDate"
+    schema = transform.WIPActivity.schema
+    layout_markers = transform.WIPActivity.layout_markers
+
+    def find_date(self, txt):
+        dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
+        first_date = dates[1] if dates else None
+        return first_date
+
+    def clean_column_name(self, col_name):
+        return re.sub(r"[^a-zA-Z0-9]", "", col_name)
+
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        # Find row contains header
+        row_header, _ = locate(df, [Anchor("header", "WIP Beg Balance")])["header"]
+        anchors = locate(
+            df,
+            [
+                # Keep ClientIdSubId column
+                Anchor(
+                    "client", "Client ID Sub ID :", how="prefix", first_row=row_header
+                ),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor("cutoff", "PTD", how="prefix", last_row=CUTOFF_LAST_ROW),
+            ],
+        )
+        # List all cols name to keep
+        keep_cols = [anchors["client"][1]] + titled_cols(
+            df, row_header, blanks=(None, "")
+        )
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path)
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        # Only the columns to keep, from the header row down
+        df = read_sheet_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        header = df.row(0)
+        names = ["Type"] + [self.clean_column_name(title) for title in header[1:]]
+
+        return (
+            select_cols(df, names)
+            .filter(pl.col("Type").is_not_null() & ~pl.col("Type").is_in(["RTD", ""]))
+            # Exclude rows has "Grand Total" to the end
+            .filter(before_last("Type", "Grand Totals"))
+            .with_columns(
+                pl.when(~pl.col("Type").is_in(["PTD", ""]))
+                .then(pl.col("Type"))
+                .forward_fill()
+                .str.split(" ")
+                .list.get(5, null_on_oob=True)
+                .alias("ClientIdSubId"),
+                pl.lit(datetime.strptime(CutOffDate, "%m/%d/%Y")).alias("CutOffDate"),
+            )
+            .filter(pl.col("Type") == "PTD")
+            .drop("row", "Type", "WIP", "RelievedWIPAdjust")
+            .collect()
+        )
+
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
+
+
+class WIPARRecon(FolderReport):
+
+    parser_version = 2
+    key_cols = None
+    period_col = "CutOff"
+    schema = transform.WIPARRecon.schema
+    layout_markers = transform.WIPARRecon.layout_markers
+
+    def find_date(self, txt):
+        dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
+        first_date = dates[1] if dates else None
+        return first_date
+
+    def clean_column_name(self, col_name):
+        return re.sub(r"[^a-zA-Z]", "", col_name)
+
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        anchors = locate(
+            df,
+            [
+                # Find row contains header
+                Anchor("header", "WIP Beg\nBalance"),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor(
+                    "cutoff",
+                    "For Accounting period dates:",
+                    how="prefix",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+            ],
+        )
+        row_header, _ = anchors["header"]
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        # Determine cols name to keep
+        keep_cols = titled_cols(df, row_header, blanks=(None, ""))
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path)
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        # Only the columns to keep, from the header row down
+        df = read_sheet_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        header = df.row(0)
+        names = [self.clean_column_name(title) for title in header]
+
+        return (
+            select_cols(df, names)
+            .filter(pl.col("row") > 0)
+            # Exclude rows has "Grand Total" to the end
+            .filter(before_last(names[0], "Grand Totals"))
+            # Client rows have exactly 6 words, the last one is the id, every
+            # other row belongs to the client above it
+            .with_columns(
+                pl.col("WIPBegBalance")
+                .str.extract(r"^(?:[^ ]* ){5}([^ ]*)$")
+                .forward_fill()
+                .alias("ClientIdSubId")
+            )
+            .filter(pl.col("Hours").is_not_null() & (pl.col("Hours") != ""))
+            .with_columns(
+                pl.col("RealPercent").str.replace_all("%", "", literal=True),
+                pl.lit(datetime.strptime(CutOffDate, "%m/%d/%Y")).alias("CutOff"),
+            )
+            .drop("row")
+            .collect()
+        )
+
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        final_df = final_df.rename(
+            {
+                "WIPBegBalance": "WIPBegin",
+                "WriteUpWriteDown": "WriteUD",
+                "WIPEndBalance": "WIPEnd",
+                "ARBegBalance": "ARBegin",
+                "InvoicewSalesTax": "InvoiceSalesTax",
+                "Adjustments": "Adjustment",
+                "FinanceCharges": "Charges",
+                "AREndBalance": "AREnd",
+            }
+        )
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
+
+
+class WIPARAging(FolderReport):
+
+    parser_version = 3
+    key_cols = ["ClientIdSubId", "CutOff"]
+    period_col = "CutOff"
+    schema = transform.WIPARAging.schema
+    layout_markers = transform.WIPARAging.layout_markers
+
+    def find_date(self, txt):
+        dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
+        first_date = dates[1] if dates else None
+        return first_date
+
+    def clean_column_name(self, col_name):
+        return re.sub(r"[^a-zA-Z0-9]", "", col_name)
+
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        # Find row contains header
+        row_header, _ = locate(df, [Anchor("header", "Total")])["header"]
+        anchors = locate(
+            df,
+            [
+                # Keep ClientIdSubId column
+                Anchor(
+                    "client", "Client ID Sub ID :", how="prefix", first_row=row_header
+                ),
+                # Keep type of transaction column
+                Anchor("type", "AR", first_row=row_header),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor(
+                    "cutoff",
+                    "For WIP dates as of:",
+                    how="prefix",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+            ],
+        )
+        # List all cols name to keep, all column has a title that is not
+        # only punctuation (e.g. "-")
+        keep_cols = [anchors["client"][1], anchors["type"][1]] + [
+            col
+            for col in titled_cols(df, row_header, blanks=(None, ""))
+            if self.clean_column_name(df.iat[row_header, col])
+        ]
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path)
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        # Only the columns to keep, from the header row down
+        df = read_sheet_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        header = df.row(0)
+        names = ["LastPaymentDate", "Type"] + [
+            self.clean_column_name(title) for title in header[2:]
+        ]
+        values = names[2:]
+
+        return (
+            select_cols(df, names)
+            .filter(pl.col("row") > 0)
+            # Exclude rows has "Grand Total" to the end
+            .filter(before_last("LastPaymentDate", "Grand Totals :"))
+            .with_columns(
+                pl.col("LastPaymentDate")
+                .str.extract(r"^\s*(?:\S+\s+){5}(\S+)")
+                .forward_fill()
+                .alias("ClientIdSubId"),
+                pl.col("LastPaymentDate")
+                .str.extract(r"\$(\d{1,3}(?:,\d{3})*(?:\.\d{2})?)")
+                .str.replace_all(",", "", literal=True)
+                .forward_fill()
+                .alias("LastPaymentAmount"),
+                pl.col("LastPaymentDate")
+                .str.extract(r"(\d{1,2}/\d{1,2}/\d{4})")
+                .forward_fill(),
+            )
+            .filter(pl.col("Type").is_in(["WIP", "AR"]))
+            .select(
+                "ClientIdSubId",
+                pl.lit(datetime.strptime(CutOffDate, "%m/%d/%Y")).alias("CutOffDate"),
+                "Type",
+                "LastPaymentDate",
+                *values,
+                "LastPaymentAmount",
+            )
+            .collect()
+        )
+
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        # AR and WIP rows of a client side by side, in one reshape
+        final_df = (
+            final_df.pivot(
+                on="Type",
+                index=["ClientIdSubId", "CutOffDate"],
+                values=final_df.columns[3:],
+                sort_columns=True,
+            )
+            .sort("ClientIdSubId", "CutOffDate")
+            .drop("LastPaymentDate_AR", "LastPaymentAmount_AR")
+            .with_columns(
+                pl.col("LastPaymentDate_WIP").str.to_datetime(
+                    "%m/%d/%Y", time_unit="ns"
+                )
+            )
+            .rename(
+                {
+                    "LastPaymentAmount_WIP": "LastPaymentAmount",
+                    "LastPaymentDate_WIP": "LastPaymentDate",
+                }
+            )
+        )
+        # CutOffDate last as before
+        final_df = final_df.select(pl.exclude("CutOffDate"), "CutOffDate")
+        final_df = final_df.rename(
+            {
+                "Total_AR": "ARTotal",
+                "Current030_AR": "AR0030",
+                "2ndAging3160_AR": "AR3160",
+                "3rdAging6190_AR": "AR6190",
+                "4thAging91120_AR": "AR91120",
+                "5thAging121150_AR": "AR121150",
+                "6thAging151180_AR": "AR151180",
+                "7thAgingOver181_AR": "AROver180",
+                "Total_WIP": "WIPTotal",
+                "Current030_WIP": "WIP0030",
+                "2ndAging3160_WIP": "WIP3160",
+                "3rdAging6190_WIP": "WIP6190",
+                "4thAging91120_WIP": "WIP91120",
+                "5thAging121150_WIP": "WIP121150",
+                "6thAging151180_WIP": "WIP151180",
+                "7thAgingOver181_WIP": "WIPOver180",
+                "CutOffDate": "CutOff",
+            }
+        )
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
@@ -0,0 +1,112 @@
+import re
+import warnings
+import numpy as np
+import pandas as pd
+from lib import instrument
+
+# The cutoff/period cells are in the first 16 rows of the pd.read_excel frames
+# the reports used to read. Those frames took the first sheet row as header, so
+# in sheet rows (row 0 = Excel row 1) the window stops before row 1 + 16
+CUTOFF_LAST_ROW = 1 + 16
+
+
+class Anchor:
+
+    def __init__(
+        self,
+        name,
+        pattern,
+        how="exact",
+        first_row=0,
+        last_row=None,
+        col=None,
+        last=False,
+        required=True,
+    ):
+        # how: "exact" (cell == pattern), "prefix" (cell starts with pattern)
+        # or "regex" (re.search(pattern, cell))
+        if how not in ("exact", "prefix", "regex"):
+            raise ValueError(f"Unknown match type: {how}")
+        self.name = name
+        self.pattern = re.compile(pattern) if how == "regex" else pattern
+        self.how = how
+        self.first_row = first_row
+        self.last_row = last_row
+        self.col = col
+        self.last = last
+        self.required = required
+
+
+class SheetCells:
+    # Flattened (row-major) view of a sheet so every anchor is one vectorized
+    # mask instead of a df.iloc[row, col] double loop
+
+    def __init__(self, df):
+        values = df.to_numpy(dtype=object)
+        self.n_rows, self.n_cols = values.shape
+        self.cells = pd.Series(values.ravel(), dtype=object)
+
+    def mask(self, anchor):
+        start = anchor.first_row
+        stop = self.n_rows if anchor.last_row is None else anchor.last_row
+        stop = max(min(stop, self.n_rows), start)
+        if anchor.col is not None:
+            cells = self.cells.iloc[
+                start * self.n_cols + anchor.col : stop * self.n_cols : self.n_cols
+            ]
+        else:
+            cells = self.cells.iloc[start * self.n_cols : stop * self.n_cols]
+        if anchor.how == "exact":
+            hits = (cells == anchor.pattern).to_numpy()
+        else:
+            try:
+                text = cells.str
+            except AttributeError:  # No text cells in this range
+                return cells.index.to_numpy()[:0]
+            if anchor.how == "prefix":
+                hits = text.startswith(anchor.pattern, na=False)
+            else:
+                with warnings.catch_warnings():
+                    # Capture groups are fine here, only the hit position is used
+                    warnings.simplefilter("ignore", UserWarning)
+                    hits = text.contains(anchor.pattern, na=False)
+            hits = hits.to_numpy(dtype=bool)
+        return cells.index.to_numpy()[hits]
+
+    def find_all(self, anchor):
+        return [divmod(int(i), self.n_cols) for i in self.mask(anchor)]
+
+    def find(self, anchor):
+        hits = self.mask(anchor)
+        if len(hits) == 0:
+            if anchor.required:
+                raise ValueError(f'Anchor "{anchor.name}" not found')
+            return None
+        return divmod(int(hits[-1] if anchor.last else hits[0]), self.n_cols)
+
+
+@instrument.timed("locate")
+def locate(df, anchors):
+    # Return {anchor.name: (row, col)} with positional coordinates, first match
+    # in reading order (or last match when anchor.last is set)
+    cells = SheetCells(df)
+    return {anchor.name: cells.find(anchor) for anchor in anchors}
+
+
+@instrument.timed("locate")
+def locate_all(df, anchor):
+    return SheetCells(df).find_all(anchor)
+
+
+def titled_cols(df, row, blanks=("None", "")):
+    # Positions of the columns whose cell in `row` is not a blank marker
+    return np.flatnonzero(~df.iloc[row].isin(blanks).to_numpy()).tolist()
+
+
+def cut_at_last(df, value, col=0):
+    # Drop the last row whose `col` cell equals value (e.g. "Grand Totals") and
+    # everything below it
+    hits = np.flatnonzero((df.iloc[:, col] == value).to_numpy())
+    if len(hits) == 0:
+        return df
+    return df.iloc[: hits[-1]]
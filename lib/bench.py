@@ -0,0 +1,372 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+import openpyxl
+from sqlalchemy import create_engine
+from lib import instrument
+from lib.ingest import concat, list_xlsx_files, parse_files
+from lib.loader import SQLLoader, bulk_copy
+
+# Parse benchmarks on synthetic CCH reports, no real data or SQL Server needed:
+#   python -m lib.bench --rows 100000 --files 10 --reports WIPARRecon WIPARAging
+# Each generator writes one workbook laid out like the CCH export of its report
+# (cover sheet first, the report on the second sheet). The workbooks are made
+# once per size in --data and reused. Every stage reports wall time, output
+# rows per second and the peak of Python allocations (tracemalloc, numpy and
+# pandas buffers included, Arrow memory of polars and calamine is not seen).
+# With --workers only the main process is traced, and the first report also
+# pays the start-up of the process pool.
+
+
+def write_workbook(path, rows):
+    wb = openpyxl.Workbook(write_only=True)
+    wb.create_sheet("Cover").append(["Report"])
+    sheet = wb.create_sheet("Report")
+    for row in rows:
+        sheet.append(row)
+    wb.save(path)
+
+
+def amount(rnd):
+    return str(round(rnd.uniform(0, 1000), 2))
+
+
+def ar_balance_listing(n_blocks, rnd, month, year):
+    yield ["AR Balance Listing"] + [None] * 8
+    yield [None] * 6 + ["Firm", None, None]
+    yield [
+        "Client ID",
+        "Client Name",
+        "Transaction Date",
+        "Document",
+        "Applied To",
+        "Amount",
+        "AR Balance",
+        "Accounting Period Date",
+        None,
+    ]
+    for c in range(n_blocks):
+        yield [f"Client ID Sub ID: C{1000 + c}.000", f"Name {c}"] + [None] * 7
+        for _ in range(rnd.randint(1, 4)):
+            yield [
+                None,
+                None,
+                f"{month}/{rnd.randint(1, 28)}/{year}",
+                f"D{rnd.randint(1, 9999)}",
+                f"A{rnd.randint(1, 99)}",
+                str(round(rnd.uniform(-500, 5000), 2)),
+                None,
+                f"{month}/28/{year}",
+                None,
+            ]
+        yield [None] * 5 + ["123.00", None, None, None]
+    yield ["Grand totals:"] + [None] * 4 + ["999", None, None, None]
+
+
+def staff_posted(n_blocks, rnd, month, year):
+    dates = f"{month}/1/{year} - {month}/28/{year}"
+    yield ["Staff Posted"] + [None] * 5
+    yield [
+        None,
+        None,
+        f"For Accounting period dates: {dates} For Transaction dates:{dates}",
+        None,
+        None,
+        None,
+    ]
+    yield [None] * 6
+    yield ["Client", "Hours", "Posted Hours", "Banked/Used Hours", "-", None]
+    for s in range(n_blocks):
+        yield [None, None, f"Staff ID : S{s:05d}", None, None, None]
+        for _ in range(rnd.randint(1, 4)):
+            banked = str(rnd.randint(0, 8))
+            if rnd.random() < 0.5:
+                banked = "B " + banked
+            hours = [str(rnd.randint(1, 9)), str(rnd.randint(1, 9))]
+            yield [str(rnd.randint(1, 99)), *hours, banked, "1", None]
+        yield [None, "10", f"Total (S{s:05d})", None, None, None]
+    yield ["Grand Totals:", "100", None, None, None, None]
+
+
+def wip_activity(n_blocks, rnd, month, year):
+    dates = f"PTD for {month}/1/{year} - {month}/28/{year}"
+    yield [None, "WIP Activity"] + [None] * 6
+    yield [None, None, None, dates] + [None] * 4
+    yield [None] * 8
+    yield [
+        None,
+        "WIP Beg Balance",
+        "Hours",
+        "WIP",
+        "Relieved WIP Adjust",
+        "WIP End Balance",
+        None,
+        None,
+    ]
+    for c in range(n_blocks):
+        yield [f"Client ID Sub ID : C{1000 + c}.000"] + [None] * 7
+        yield ["PTD"] + [amount(rnd) for _ in range(5)] + [None, None]
+        yield ["RTD"] + [amount(rnd) for _ in range(5)] + [None, None]
+    yield ["Grand Totals"] + ["1"] * 5 + [None, None]
+
+
+def wip_ar_recon(n_blocks, rnd, month, year):
+    header = [
+        "WIP Beg\nBalance",
+        "Hours",
+        "Write Up/Write Down",
+        "WIP End\nBalance",
+        "AR Beg\nBalance",
+        "Invoice w/Sales Tax",
+        "Adjustments",
+        "Finance Charges",
+        "AR End\nBalance",
+        "Real Percent",
+    ]
+    width = len(header) + 1
+    yield ["WIP AR Recon"] + [None] * (width - 1)
+    dates = f"For Accounting period dates: {month}/1/{year} - {month}/28/{year}"
+    yield [None, dates] + [None] * (width - 2)
+    yield [None] * width
+    yield header + [None]
+    for c in range(n_blocks):
+        yield [f"Client ID Sub ID : C{1000 + c}.000"] + [None] * (width - 1)
+        for _ in range(rnd.randint(1, 3)):
+            numbers = [amount(rnd) for _ in range(len(header) - 1)]
+            yield numbers + [f"{rnd.randint(0, 100)}%", None]
+    yield ["Grand Totals"] + ["1"] * (len(header) - 1) + ["1%", None]
+
+
+AGING = [
+    "Total",
+    "Current 0-30",
+    "2nd Aging 31-60",
+    "3rd Aging 61-90",
+    "4th Aging 91-120",
+    "5th Aging 121-150",
+    "6th Aging 151-180",
+    "7th Aging Over 181",
+]
+
+
+def wip_ar_aging(n_blocks, rnd, month, year):
+    width = len(AGING) + 3
+    yield [None, "WIP AR Aging"] + [None] * (width - 2)
+    dates = f"For WIP dates as of: {month}/1/{year} - {month}/28/{year}"
+    yield [None, None, dates] + [None] * (width - 3)
+    yield [None] * width
+    yield [None, None] + AGING + ["-"]
+    for c in range(n_blocks):
+        yield [f"Client ID Sub ID : C{1000 + c}.000 Name"] + [None] * (width - 1)
+        paid = (
+            f"Last Payment: {month}/{rnd.randint(1, 28)}/{year} "
+            f"${rnd.randint(1, 99)},{rnd.randint(100, 999)}.{rnd.randint(10, 99)}"
+        )
+        yield [paid, "WIP"] + [amount(rnd) for _ in AGING] + [None]
+        yield [None, "AR"] + [amount(rnd) for _ in AGING] + [None]
+    yield ["Grand Totals :", None] + ["1"] * len(AGING) + [None]
+
+
+def staff_list(n_blocks, rnd, month, year):
+    # Blocks of 8 rows per staff, fields at the fixed cells StaffList reads
+    rows = [[None] * 15 for _ in range(4)]
+    rows[1][2] = "Staff List"
+    rows[3][2] = "Staff ID"
+    yield from rows
+    for s in range(n_blocks):
+        block = [[None] * 15 for _ in range(8)]
+        block[1][2], block[1][3], block[1][14] = f"S{s:05d}", f"Report {s}", "Active"
+        block[2][2], block[2][3] = "Full Name:", f"Full {s}"
+        block[3][2] = "Email:"
+        block[4][2], block[4][3] = "Office:", f"Office {rnd.randint(1, 3)}"
+        block[5][2], block[5][3] = "BU:", f"BU {rnd.randint(1, 2)}"
+        block[5][10] = f"Manager {rnd.randint(1, 4)}"
+        block[6][2], block[6][3] = "Department:", f"Dept {rnd.randint(1, 5)}"
+        block[7][2], block[7][3] = "Pay Type:", "Salary"
+        yield from block
+
+
+def staff_monthly(n_blocks, rnd, month, year):
+    width = 20
+    # Month columns D:F, I:N and Q:T as StaffMonthly reads them
+    cols = [3, 4, 5, 8, 9, 10, 11, 12, 13, 16, 17, 18, 19]
+    rows = [[None] * width for _ in range(4)]
+    rows[2][7] = f"For the Dates {month}/1/{year} - {month}/28/{year}"
+    yield from rows
+    for s in range(n_blocks):
+        row = [None] * width
+        row[1] = f"Staff ID : S{s:05d} Name"
+        yield row
+        if s == 0:
+            row = [None] * width
+            row[1] = str(year)
+            yield row
+        for _ in range(5):
+            row = [None] * width
+            row[1] = "metric"
+            for col in cols:
+                draw = rnd.random()
+                if 0.1 <= draw < 0.4:
+                    row[col] = f"{rnd.randint(1, 9)},{rnd.randint(100, 999)}.00"
+                elif draw >= 0.4:
+                    row[col] = round(rnd.uniform(0, 100), 2)
+            yield row
+    row = [None] * width
+    row[1] = "Grand Totals"
+    yield row
+
+
+# Report class: generator and its output rows per block (client or staff)
+GENERATORS = {
+    "ARBalanceListing": (ar_balance_listing, 2.5),
+    "StaffPosted": (staff_posted, 2.5),
+    "WIPActivity": (wip_activity, 1),
+    "WIPARRecon": (wip_ar_recon, 2),
+    "WIPARAging": (wip_ar_aging, 1),
+    "StaffList": (staff_list, 1),
+    "StaffMonthly": (staff_monthly, 5),
+}
+
+
+def make_reports(folder, report, n_rows, n_files=1, seed=0):
+    # n_files workbooks of report in folder, about n_rows output rows in total.
+    # File i is the month i after January 2024 so period reports do not
+    # collide. StaffList is a single workbook whatever n_files.
+    generate, per_block = GENERATORS[report]
+    if report == "StaffList":
+        n_files = 1
+    os.makedirs(folder, exist_ok=True)
+    n_blocks = max(1, round(n_rows / n_files / per_block))
+    for i in range(n_files):
+        rnd = random.Random(seed + i)
+        path = os.path.join(folder, f"{report}_{i:03d}.xlsx")
+        write_workbook(path, generate(n_blocks, rnd, i % 12 + 1, 2024 + i // 12))
+    return folder
+
+
+def report_folder(data_dir, report, n_rows, n_files):
+    # Generated once per report and size
+    folder = os.path.join(data_dir, f"{report}-{n_rows}-{n_files}")
+    if not os.path.isdir(folder) or not list_xlsx_files(folder):
+        make_reports(folder, report, n_rows, n_files)
+    return folder
+
+
+def measure(stage, fn):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn()
+        seconds = time.perf_counter() - start
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return result, {"stage": stage, "seconds": seconds, "peak_mib": peak / 2**20}
+
+
+def make_parser(module, report, folder, **kwargs):
+    cls = getattr(module, report)
+    if report == "StaffList":
+        return cls(os.path.join(folder, list_xlsx_files(folder)[0]))
+    if report == "StaffMonthly":
+        return cls(folder, "Etc/GMT-6", **kwargs)
+    return cls(folder, **kwargs)
+
+
+def bench_report(module, report, folder, workers=None, load=False, bulk=False):
+    # Stages of process_files, timed apart: parse every file, concatenate and
+    # finalize, then optionally write to an in-memory SQLite table (through
+    # staging files with bulk)
+    parser = make_parser(module, report, folder, workers=workers)
+    if report == "StaffList":
+        file_paths = [parser.file_path]
+    else:
+        file_paths = [os.path.join(folder, file) for file in list_xlsx_files(folder)]
+    df_list, parsed = measure("parse", lambda: parse_files(parser, file_paths))
+    if hasattr(parser, "running_time"):
+        finalize = lambda df: parser.finalize(df, parser.running_time())
+    else:
+        finalize = parser.finalize
+    schema = getattr(parser, "schema", None)
+    df, finalized = measure("finalize", lambda: finalize(concat(df_list, schema)))
+    stages = [parsed, finalized]
+    if load:
+        engine = create_engine("sqlite://")
+        loader = SQLLoader(engine, report, bulk=bulk_copy(engine) if bulk else None)
+        stages.append(measure("load", lambda: loader.load(df))[1])
+    total = {
+        "stage": "total",
+        "seconds": sum(stage["seconds"] for stage in stages),
+        "peak_mib": max(stage["peak_mib"] for stage in stages),
+    }
+    results = []
+    for stage in stages + [total]:
+        stage["rows"] = len(df)
+        stage["rows_per_sec"] = len(df) / stage["seconds"] if stage["seconds"] else 0
+        results.append({"module": module.__name__, "report": report, **stage})
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Parse benchmarks on synthetic reports"
+    )
+    parser.add_argument("--rows", type=int, default=10000, help="rows per report")
+    parser.add_argument("--files", type=int, default=10, help="files per report")
+    parser.add_argument("--reports", nargs="+", default=list(GENERATORS))
+    parser.add_argument(
+        "--modules",
+        nargs="+",
+        default=["lib.transform"],
+        help="lib.transform, lib.Pandastransform, lib.Polarstransform",
+    )
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--load", action="store_true", help="time a SQLite load")
+    parser.add_argument(
+        "--bulk", action="store_true", help="load through staging files"
+    )
+    parser.add_argument(
+        "--detail", action="store_true", help="lib.instrument stages per report"
+    )
+    parser.add_argument(
+        "--data", default=os.path.join(tempfile.gettempdir(), "cch-bench")
+    )
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = []
+    for name in args.modules:
+        module = importlib.import_module(name)
+        for report in args.reports:
+            if not hasattr(module, report):
+                continue
+            folder = report_folder(args.data, report, args.rows, args.files)
+            if args.detail:
+                # Timings only, the stages above already trace memory
+                instrument.enable(memory=False)
+            for result in bench_report(
+                module, report, folder, args.workers, args.load, args.bulk
+            ):
+                results.append(result)
+                print(
+                    f"{result['module']:22} {result['report']:17} "
+                    f"{result['stage']:9} {result['seconds']:8.3f}s "
+                    f"{result['rows_per_sec']:12,.0f} rows/s "
+                    f"{result['peak_mib']:9.1f} MiB"
+                )
+            if args.detail:
+                print(instrument.summary().drop(columns="peak_mib").to_string())
+                instrument.disable()
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=1)
+    return results
+
+
+if __name__ == "__main__":
+    main()
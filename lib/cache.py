@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+import pandas as pd
+import polars as pl
+
+
+class ParseCache:
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        # Parsed per-file DataFrames stored as Parquet (pickle when a column
+        # cannot be written as Arrow), oldest-used evicted past max_bytes.
+        # Shared by the threads of lib.orchestrate and the worker processes:
+        # temp files are per process and thread, and an entry evicted by
+        # another one meanwhile is a miss
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def file_hash(self, file_path):
+        h = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def key(self, file_path, tag):
+        # tag identifies the parser (class, parser_version, layout)
+        stat = os.stat(file_path)
+        ident = [
+            os.path.abspath(file_path),
+            stat.st_size,
+            stat.st_mtime_ns,
+            self.file_hash(file_path),
+            tag,
+        ]
+        return hashlib.sha256(json.dumps(ident).encode()).hexdigest()
+
+    def entries(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith((".parquet", ".pkl")):
+                yield os.path.join(self.cache_dir, name)
+
+    def get(self, key):
+        for ext, read in (
+            (".parquet", pd.read_parquet),
+            (".pl.parquet", pl.read_parquet),
+            (".pkl", pd.read_pickle),
+        ):
+            path = os.path.join(self.cache_dir, key + ext)
+            try:
+                os.utime(path)  # Mark as recently used for eviction
+                return read(path)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def tmp_path(self, path):
+        return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def put(self, key, df):
+        if isinstance(df, pl.DataFrame):
+            # Polars frames come back as polars frames
+            path = os.path.join(self.cache_dir, key + ".pl.parquet")
+            tmp = self.tmp_path(path)
+            df.write_parquet(tmp)
+            os.replace(tmp, path)
+            self.evict()
+            return
+        path = os.path.join(self.cache_dir, key + ".parquet")
+        tmp = self.tmp_path(path)
+        try:
+            df.to_parquet(tmp, index=True)
+        except (TypeError, ValueError, ImportError):
+            # Mixed-type object columns (and a missing pyarrow) can't go to
+            # Parquet, keep those as pickle
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            path = os.path.join(self.cache_dir, key + ".pkl")
+            tmp = self.tmp_path(path)
+            df.to_pickle(tmp)
+        os.replace(tmp, path)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for path in self.entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:  # Evicted by another thread or worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self.remove(path)
+            total -= size
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def clear(self):
+        for path in list(self.entries()):
+            self.remove(path)
@@ -0,0 +1,237 @@
+import json
+import os
+import multiprocessing
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+import pandas as pd
+import polars as pl
+from lib import instrument
+from lib.schema import shared_categories
+
+_executors = {}
+_executors_lock = threading.Lock()
+
+
+def list_xlsx_files(folder_path):
+    # Sorted so the output order does not depend on os.listdir
+    return sorted(
+        f
+        for f in os.listdir(folder_path)
+        if f.endswith(".xlsx") and not (f.startswith("~"))
+    )
+
+
+def shared_executor(workers):
+    # One process pool per size, reused by every report class so a run over
+    # several reports only pays the worker start-up once. "spawn" because
+    # forking after polars has started its thread pool can deadlock the
+    # workers (and it is what Windows uses anyway).
+    # The lock is for reports run from several threads (lib.orchestrate)
+    with _executors_lock:
+        if workers not in _executors:
+            _executors[workers] = ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executors[workers]
+
+
+def shutdown_executors():
+    for executor in _executors.values():
+        executor.shutdown()
+    _executors.clear()
+
+
+def parser_tag(parser, **kwargs):
+    # Identifies what produced a cached frame: the report class, its
+    # parser_version and the extra parse_file arguments (e.g. the layout)
+    cls = type(parser)
+    return json.dumps(
+        [cls.__module__, cls.__qualname__, getattr(cls, "parser_version", 0), kwargs],
+        sort_keys=True,
+        default=str,
+    )
+
+
+def parse_one(parse_file, file_path):
+    with instrument.stage("parse_file", file=os.path.basename(file_path)) as s:
+        df = parse_file(file_path)
+        s.rows = len(df)
+    return df
+
+
+def recorded(parse_file):
+    # parse_file as run by a worker: with lib.instrument on, the worker records
+    # too and its events come back with the frame (see unpack)
+    if not instrument.enabled():
+        return parse_file
+    return partial(instrument.call_recorded, instrument.memory(), parse_file)
+
+
+def unpack(result):
+    if isinstance(result, tuple):
+        df, worker_events = result
+        instrument.merge(worker_events)
+        return df
+    return result
+
+
+def concat(df_list, schema=None):
+    # All files of a report in one frame, pandas or polars. The "category"
+    # columns of schema are encoded per file first, see
+    # lib.schema.shared_categories
+    with instrument.stage("concat") as s:
+        if schema:
+            df_list = shared_categories(df_list, schema)
+        if isinstance(df_list[0], pl.DataFrame):
+            df = pl.concat(df_list)
+        else:
+            df = pd.concat(df_list, ignore_index=True)
+        s.rows = len(df)
+    return df
+
+
+@instrument.timed("parse_files")
+def parse_files(parser, file_paths, **kwargs):
+    # Calls parser.parse_file(file_path, **kwargs) for every file.
+    # parser.workers=None (or 1) keeps the serial path so both can be
+    # benchmarked; executor.map returns results in input order, so the output
+    # is the same whichever worker finishes first. With parser.cache set,
+    # unchanged files are loaded from the cache and only the rest are parsed.
+    parse_file = partial(parse_one, partial(parser.parse_file, **kwargs))
+    workers = getattr(parser, "workers", None)
+    cache = getattr(parser, "cache", None)
+
+    results = [None] * len(file_paths)
+    if cache is not None:
+        tag = parser_tag(parser, **kwargs)
+        keys = [cache.key(file_path, tag) for file_path in file_paths]
+        for i, key in enumerate(keys):
+            results[i] = cache.get(key)
+    todo = [i for i, df in enumerate(results) if df is None]
+    todo_paths = [file_paths[i] for i in todo]
+
+    if not workers or workers <= 1 or len(todo_paths) <= 1:
+        parsed = [parse_file(file_path) for file_path in todo_paths]
+    else:
+        parsed = shared_executor(workers).map(recorded(parse_file), todo_paths)
+    for i, df in zip(todo, parsed):
+        df = unpack(df)
+        results[i] = df
+        if cache is not None:
+            cache.put(keys[i], df)
+    return results
+
+
+def iter_parsed(parser, file_paths, **kwargs):
+    # parse_files as a generator: one frame per file, in input order, with the
+    # cache the same way. With parser.workers > 1 only `workers` files are
+    # parsed ahead of the one being consumed, so at most that many frames are
+    # in memory instead of the whole folder.
+    parse_file = partial(parse_one, partial(parser.parse_file, **kwargs))
+    workers = getattr(parser, "workers", None)
+    cache = getattr(parser, "cache", None)
+    parallel = workers and workers > 1 and len(file_paths) > 1
+    tag = parser_tag(parser, **kwargs)
+    pending = deque()
+    for file_path in file_paths:
+        key = cache.key(file_path, tag) if cache is not None else None
+        df = cache.get(key) if cache is not None else None
+        fresh = df is None
+        if fresh:
+            if parallel:
+                df = shared_executor(workers).submit(recorded(parse_file), file_path)
+            else:
+                df = parse_file(file_path)
+        pending.append((key, df, fresh))
+        while len(pending) > (workers if parallel else 0):
+            yield finish_parsed(cache, *pending.popleft())
+    while pending:
+        yield finish_parsed(cache, *pending.popleft())
+
+
+def finish_parsed(cache, key, df, fresh):
+    if isinstance(df, Future):
+        df = unpack(df.result())
+    if fresh and cache is not None:
+        cache.put(key, df)
+    return df
+
+
+def iter_batches(parser, file_paths, finalize, batch_rows=None, **kwargs):
+    # Finished frames one file at a time: finalize(df) is what process_files
+    # does to the concatenated frame (renames, types ...), applied per file,
+    # then split in frames of at most batch_rows rows if given. For
+    # lib.loader.SQLLoader.load or any writer taking an iterable of frames,
+    # memory stays about constant whatever the number of files.
+    for df in iter_parsed(parser, file_paths, **kwargs):
+        df = finalize(df)
+        if not batch_rows:
+            yield df
+            continue
+        for start in range(0, len(df), batch_rows):
+            yield df[start : start + batch_rows]
+
+
+class Abort:
+    # Put in the queue of load_pipelined when producing the batches failed
+    def __init__(self, error):
+        self.error = error
+
+
+DONE = object()
+
+
+def load_pipelined(batches, load, depth=2):
+    # load(iterable of frames), e.g. lib.loader.SQLLoader.load, runs in a
+    # writer thread while this thread produces the batches (iter_batches parses
+    # the next files meanwhile), so a run takes about max(parse, load) instead
+    # of parse + load. At most `depth` batches wait in between, which caps the
+    # memory. Returns what load returns. If producing a batch fails, load sees
+    # the error (SQLLoader rolls back) and it is raised here; if load fails,
+    # no more batches are produced.
+    pending = queue.Queue(maxsize=depth)
+    outcome = {}
+
+    def consume():
+        while True:
+            item = pending.get()
+            if item is DONE:
+                return
+            if isinstance(item, Abort):
+                raise item.error
+            yield item
+
+    def write():
+        try:
+            outcome["result"] = load(consume())
+        except BaseException as e:
+            outcome["error"] = e
+
+    def put(item):
+        # Stops waiting for room in the queue if the writer died
+        while writer.is_alive():
+            try:
+                pending.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    writer = threading.Thread(target=write, name="load_pipelined", daemon=True)
+    writer.start()
+    try:
+        for df in batches:
+            if not put(df):
+                break
+    except BaseException as e:
+        put(Abort(e))
+        writer.join()
+        raise
+    put(DONE)
+    writer.join()
+    if "error" in outcome:
+        raise outcome["error"]
+    return outcome["result"]
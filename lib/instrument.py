@@ -0,0 +1,223 @@
+import os
+import threading
+import time
+import tracemalloc
+from itertools import count
+from functools import wraps
+import pandas as pd
+
+# Per-stage timings, row counts and memory peaks of a run, off by default:
+#   instrument.enable()
+#   df = transform.WIPARAging(folder, workers=4).process_files()
+#   print(instrument.summary())
+# The stages are the reading of the sheets (peek, read), the layout detection
+# (layout, locate), each file (parse_file, with its file name), concat,
+# finalize, schema (type casts) and the SQL or Parquet load (load, write).
+# Stages nest: self_seconds is the time not spent in an inner stage, so the
+# fill-down of a report is the self_seconds of its parse_file. peak_mib is
+# what the stage allocated on top of what was in use when it started
+# (tracemalloc, numpy and pandas buffers included, not Arrow memory).
+# Disabled, stage() and timed() cost one check of a global.
+
+_recorder = None
+
+
+class Recorder:
+
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.events = []
+        # Stages open in each thread (reports run by lib.orchestrate)
+        self.local = threading.local()
+        self.ids = count(1)
+        # Only stop tracemalloc in disable() if it was started here
+        self.tracing = memory and not tracemalloc.is_tracing()
+        if self.tracing:
+            tracemalloc.start()
+
+    @property
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def next_id(self):
+        return f"{os.getpid()}:{next(self.ids)}"
+
+
+class Stage:
+
+    def __init__(self, recorder, name, fields):
+        self.recorder = recorder
+        self.name = name
+        self.fields = fields
+        self.rows = None
+
+    def __enter__(self):
+        recorder = self.recorder
+        self.parent = recorder.stack[-1] if recorder.stack else None
+        if self.parent is not None and "file" in self.parent.fields:
+            self.fields = {"file": self.parent.fields["file"], **self.fields}
+        self.id = recorder.next_id()
+        if recorder.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, peak)
+            tracemalloc.reset_peak()
+            self.base = self.peak = current
+        recorder.stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self.start
+        recorder = self.recorder
+        recorder.stack.pop()
+        peak_mib = None
+        if recorder.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+            if self.parent is not None:
+                self.parent.peak = max(self.parent.peak, self.peak)
+            peak_mib = (self.peak - self.base) / 2**20
+        recorder.events.append(
+            {
+                "stage": self.name,
+                "id": self.id,
+                "parent": self.parent.id if self.parent is not None else None,
+                "seconds": seconds,
+                "rows": self.rows,
+                "peak_mib": peak_mib,
+                "failed": exc_type is not None,
+                "pid": os.getpid(),
+                **self.fields,
+            }
+        )
+        return False
+
+
+class NullStage:
+    # What stage() gives when disabled, setting rows on it does nothing
+
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NULL_STAGE = NullStage()
+
+
+def enable(memory=True):
+    # memory=False only times, tracemalloc slows Python code down noticeably
+    global _recorder
+    disable()
+    _recorder = Recorder(memory)
+
+
+def disable():
+    # Stops recording, returns the events recorded
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is None:
+        return []
+    if recorder.tracing:
+        tracemalloc.stop()
+    return recorder.events
+
+
+def enabled():
+    return _recorder is not None
+
+
+def memory():
+    return _recorder is not None and _recorder.memory
+
+
+def events():
+    return list(_recorder.events) if _recorder is not None else []
+
+
+def clear():
+    if _recorder is not None:
+        _recorder.events.clear()
+
+
+def stage(name, **fields):
+    # with stage("concat") as s: ...; s.rows = len(df)
+    if _recorder is None:
+        return NULL_STAGE
+    return Stage(_recorder, name, fields)
+
+
+def row_count(result):
+    if hasattr(result, "shape"):
+        return result.shape[0]
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    if isinstance(result, list) and all(hasattr(df, "shape") for df in result):
+        return sum(df.shape[0] for df in result)
+    return None
+
+
+def timed(name):
+    # Decorator, a stage around every call, rows from the result
+    def decorate(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _recorder is None:
+                return fn(*args, **kwargs)
+            with Stage(_recorder, name, {}) as s:
+                result = fn(*args, **kwargs)
+                s.rows = row_count(result)
+            return result
+
+        return wrapper
+
+    return decorate
+
+
+def call_recorded(memory, fn, *args):
+    # Runs fn in a worker process with recording on, returns (result, events)
+    # for merge() in the parent
+    enable(memory)
+    try:
+        result = fn(*args)
+    finally:
+        worker_events = disable()
+    return result, worker_events
+
+
+def merge(worker_events):
+    # Events of a worker under the stage open in this process
+    if _recorder is None:
+        return
+    parent = _recorder.stack[-1].id if _recorder.stack else None
+    for event in worker_events:
+        if event["parent"] is None:
+            event = {**event, "parent": parent}
+        _recorder.events.append(event)
+
+
+def summary(events_list=None, by="stage"):
+    # One row per stage (or per [stage, file] ...): calls, total and self
+    # seconds, rows and the largest peak, in order of first appearance
+    df = pd.DataFrame(events() if events_list is None else events_list)
+    if df.empty:
+        return df
+    inner = df.groupby("parent")["seconds"].sum()
+    # Files parsed in parallel overlap, their parent has no time of its own
+    df["self_seconds"] = (df["seconds"] - df["id"].map(inner).fillna(0)).clip(0)
+    return (
+        df.groupby(by, sort=False)
+        .agg(
+            calls=("seconds", "size"),
+            seconds=("seconds", "sum"),
+            self_seconds=("self_seconds", "sum"),
+            rows=("rows", lambda rows: rows.sum(min_count=1)),
+            peak_mib=("peak_mib", "max"),
+        )
+        .reset_index()
+    )
@@ -0,0 +1,90 @@
+import hashlib
+import json
+import os
+import re
+import threading
+import polars as pl
+from lib import instrument
+from lib.anchor import SheetCells
+from lib.ingest import parser_tag
+
+# Resolved report layouts (header row, kept columns, cutoff cell ...) keyed by a
+# fingerprint of the top of the sheet. Files laid out like one seen before skip
+# the anchor scan, a file with a new layout gets its own detection instead of
+# being parsed with the positions of another file.
+
+DIGITS = re.compile(r"\d")
+
+
+def fingerprint(df, markers, n_rows=20):
+    # Where each marker (lib.anchor.Anchor) first shows up in the first n_rows,
+    # the titles of the row of the first marker (the header row) with digits
+    # replaced by 0, and the number of columns. Works on pandas and polars
+    # frames of text.
+    top = df.head(n_rows)
+    if isinstance(top, pl.DataFrame):
+        top = top.to_pandas()
+    cells = SheetCells(top)
+    hits = []
+    for anchor in markers:
+        found = cells.mask(anchor)
+        hits.append(divmod(int(found[0]), cells.n_cols) if len(found) else None)
+    titles = []
+    if hits and hits[0] is not None:
+        titles = [
+            DIGITS.sub("0", value) if isinstance(value, str) else ""
+            for value in top.iloc[hits[0][0]]
+        ]
+    ident = [df.shape[1], hits, titles]
+    return hashlib.sha256(json.dumps(ident).encode()).hexdigest()
+
+
+class LayoutCache:
+
+    def __init__(self, path=None, n_rows=20):
+        # Layouts per report class (parser_tag) and fingerprint. In memory, and
+        # with path also in a JSON file so later runs skip detection too.
+        # n_rows is the first peek of a sheet, see
+        # lib.report.FolderReport.peek_layout
+        self.path = path
+        self.n_rows = n_rows
+        self.layouts = self.read()
+
+    def read(self):
+        if self.path is None or not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    @instrument.timed("layout")
+    def resolve(self, parser, df):
+        # parser.detect_layout(df) only for a layout not seen before, the
+        # fingerprint uses parser.layout_markers over all the rows of df (a
+        # larger peek of the same sheet is another layout key)
+        tag = parser_tag(parser)
+        key = fingerprint(df, parser.layout_markers, len(df))
+        layouts = self.layouts.setdefault(tag, {})
+        if key not in layouts:
+            # A worker process or an earlier file may have stored it meanwhile
+            layouts.update(self.read().get(tag, {}))
+        if key not in layouts:
+            # Through JSON so a fresh layout looks the same as a stored one
+            layout = json.loads(json.dumps(parser.detect_layout(df), default=int))
+            layouts[key] = layout
+            self.save(tag, key, layout)
+        return layouts[key]
+
+    def save(self, tag, key, layout):
+        if self.path is None:
+            return
+        # Merge with what other workers or runs wrote since this one read it,
+        # again if a worker writing at the same time dropped this layout
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        for _ in range(5):
+            layouts = self.read()
+            if layouts.get(tag, {}).get(key) == layout:
+                return
+            layouts.setdefault(tag, {})[key] = layout
+            with open(tmp, "w") as f:
+                json.dump(layouts, f, indent=1, sort_keys=True)
+            os.replace(tmp, self.path)
@@ -0,0 +1,634 @@
+import csv
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urllib.parse
+import uuid
+from contextlib import contextmanager
+from functools import partial
+import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.dataset as ds
+from sqlalchemy import (
+    Column,
+    Index,
+    MetaData,
+    Table,
+    and_,
+    create_engine,
+    exists,
+    inspect,
+    select,
+)
+from sqlalchemy.types import (
+    BigInteger,
+    Boolean,
+    DateTime,
+    Float,
+    Unicode,
+    UnicodeText,
+)
+from lib import instrument
+
+MODES = ("replace", "append", "period", "merge")
+# Length of the text key and category columns (NVARCHAR(255) on SQL Server),
+# NVARCHAR(MAX) cannot be indexed
+KEY_LENGTH = 255
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def sql_type(dtype):
+    # Explicit column types instead of leaving the choice to pandas inference
+    if isinstance(dtype, pd.CategoricalDtype):
+        if isinstance(sql_type(dtype.categories.dtype), UnicodeText):
+            return Unicode(KEY_LENGTH)
+        return sql_type(dtype.categories.dtype)
+    if pd.api.types.is_bool_dtype(dtype):
+        return Boolean()
+    if pd.api.types.is_integer_dtype(dtype):
+        return BigInteger()
+    if pd.api.types.is_float_dtype(dtype):
+        return Float(53)
+    if pd.api.types.is_datetime64_any_dtype(dtype):
+        return DateTime()
+    return UnicodeText()
+
+
+def sql_server_url(
+    server, database, user, password, driver="ODBC Driver 17 for SQL Server"
+):
+    connect_string = urllib.parse.quote_plus(
+        "DRIVER={" + driver + "};"
+        "Server=" + server + ";"
+        "Database=" + database + ";"
+        "UID=" + user + ";"
+        "PWD=" + password + ";"
+    )
+    return f"mssql+pyodbc:///?odbc_connect={connect_string}"
+
+
+def shared_engine(url, **kwargs):
+    # One engine (and connection pool) per URL and options, reused by every
+    # load to that database instead of a new login per table. kwargs go to
+    # create_engine (fast_executemany, pool_size, max_overflow ...).
+    key = (url, tuple(sorted(kwargs.items())))
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = create_engine(url, **{"pool_pre_ping": True, **kwargs})
+        return _engines[key]
+
+
+def dispose_engines():
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def table_sql(connection, table_name, schema=None):
+    preparer = connection.dialect.identifier_preparer
+    if schema:
+        return f"{preparer.quote_schema(schema)}.{preparer.quote(table_name)}"
+    return preparer.quote(table_name)
+
+
+def rename_table(connection, table_name, new_name, schema=None):
+    if connection.dialect.name == "mssql":
+        old = table_sql(connection, table_name, schema).replace("'", "''")
+        new = new_name.replace("'", "''")
+        connection.exec_driver_sql(f"EXEC sp_rename '{old}', '{new}'")
+    else:
+        connection.exec_driver_sql(
+            f"ALTER TABLE {table_sql(connection, table_name, schema)} "
+            f"RENAME TO {connection.dialect.identifier_preparer.quote(new_name)}"
+        )
+
+
+class SQLLoader:
+
+    def __init__(
+        self,
+        engine,
+        table_name,
+        dtype=None,
+        chunksize=10000,
+        schema=None,
+        mode="replace",
+        key_cols=None,
+        period_col=None,
+        bulk=None,
+    ):
+        # engine: any SQLAlchemy engine (SQL Server in production, SQLite for
+        # local runs). dtype: {column: SQLAlchemy type} overriding sql_type()
+        # mode:
+        #   "replace" load the batches into a shadow table, then swap it in
+        #             for the table (readers keep the old rows until then)
+        #   "append"  insert the batches, creating the table if missing
+        #   "period"  delete the period_col values (e.g. CutOff) present in the
+        #             batches, then insert them
+        #   "merge"   replace the rows matching key_cols (e.g. ClientIdSubId +
+        #             CutOff), going through a staging table
+        # bulk: a BulkCopy (bulk_copy(engine)) writing each batch through a
+        # staging file instead of to_sql row inserts
+        if mode not in MODES:
+            raise ValueError(f"Unknown load mode: {mode}")
+        if mode == "period" and not period_col:
+            raise ValueError('mode="period" needs period_col')
+        if mode == "merge" and not key_cols:
+            raise ValueError('mode="merge" needs key_cols')
+        self.engine = engine
+        self.table_name = table_name
+        self.dtype = dtype or {}
+        self.chunksize = chunksize
+        self.schema = schema
+        self.mode = mode
+        self.key_cols = key_cols
+        self.period_col = period_col
+        self.bulk = bulk
+
+    def column_types(self, df):
+        types = {col: sql_type(df[col].dtype) for col in df.columns}
+        for col in (self.key_cols or []) + [self.period_col or ""]:
+            if isinstance(types.get(col), UnicodeText):
+                types[col] = Unicode(KEY_LENGTH)
+        types.update({col: t for col, t in self.dtype.items() if col in types})
+        return types
+
+    def table(self, df, table_name=None):
+        return Table(
+            table_name or self.table_name,
+            MetaData(),
+            *[Column(col, t) for col, t in self.column_types(df).items()],
+            schema=self.schema,
+        )
+
+    def create_table(self, connection, df):
+        table = self.table(df)
+        if self.mode == "replace":
+            table = self.table(df, f"{self.table_name}_shadow")
+            table.drop(connection, checkfirst=True)
+        elif inspect(connection).has_table(self.table_name, schema=self.schema):
+            return Table(
+                self.table_name,
+                MetaData(),
+                autoload_with=connection,
+                schema=self.schema,
+            )
+        table.create(connection)
+        self.create_indexes(connection, table)
+        return table
+
+    def create_indexes(self, connection, table):
+        # period_col for the deletes of mode="period", key_cols for the join of
+        # mode="merge", so they touch the rows of the loaded data only. Unique
+        # names: SQLite index names are per database, and the indexes of a
+        # shadow table keep their names after the swap.
+        token = uuid.uuid4().hex[:8]
+        indexes = []
+        if self.period_col and self.period_col in table.c:
+            indexes.append(("period", [self.period_col]))
+        if self.key_cols and all(col in table.c for col in self.key_cols):
+            indexes.append(("key", self.key_cols))
+        for kind, cols in indexes:
+            Index(
+                f"ix_{self.table_name}_{kind}_{token}", *[table.c[col] for col in cols]
+            ).create(connection)
+
+    def write(self, connection, df, table_name=None):
+        with instrument.stage("write") as s:
+            if self.bulk is not None:
+                self.bulk.write(
+                    connection, df, table_name or self.table_name, self.schema
+                )
+            else:
+                df.to_sql(
+                    table_name or self.table_name,
+                    connection,
+                    schema=self.schema,
+                    index=False,
+                    if_exists="append",
+                    chunksize=self.chunksize,
+                )
+            s.rows = len(df)
+
+    def delete_periods(self, connection, table, df, cleared):
+        # Only the first batch of a period clears it, later batches of the same
+        # period are part of this load
+        periods = [
+            p
+            for p in df[self.period_col].drop_duplicates().dropna().tolist()
+            if p not in cleared
+        ]
+        if periods:
+            connection.execute(
+                table.delete().where(table.c[self.period_col].in_(periods))
+            )
+            cleared.update(periods)
+
+    def merge(self, connection, table, df):
+        staging = self.table(df, f"{self.table_name}_staging")
+        staging.drop(connection, checkfirst=True)
+        staging.create(connection)
+        self.write(connection, df, staging.name)
+        connection.execute(
+            table.delete().where(
+                exists().where(
+                    and_(*[staging.c[col] == table.c[col] for col in self.key_cols])
+                )
+            )
+        )
+        connection.execute(
+            table.insert().from_select(
+                list(df.columns), select(*[staging.c[col] for col in df.columns])
+            )
+        )
+        staging.drop(connection)
+
+    @instrument.timed("load")
+    def load(self, batches, connection=None, swaps=None):
+        # batches: one DataFrame or any iterable/generator of DataFrames (e.g.
+        # the iter_batches() of a report class). The table is created from the
+        # first batch if needed and every batch is written in one transaction,
+        # so a failed load leaves the old data in place. Polars frames
+        # (lib.Polarstransform) are converted here, at the sink.
+        # connection: write in that connection's open transaction instead
+        # (SQLSink.transaction), committed or rolled back by its owner.
+        # swaps: a list to add the swap of mode="replace" to instead of
+        # running it, for that owner to run right before its commit
+        if connection is None:
+            try:
+                with self.engine.begin() as connection:
+                    return self.write_batches(connection, batches)
+            except BaseException:
+                self.drop_work_tables()
+                raise
+        return self.write_batches(connection, batches, swaps)
+
+    def drop_work_tables(self):
+        # After a rollback. SQLite does not roll back DDL, so a failed load
+        # would leave its shadow or staging table behind (SQL Server rolls
+        # them back with the rest). Best effort, the load's error is the one
+        # to report.
+        names = {"replace": "_shadow", "merge": "_staging"}
+        if self.mode not in names:
+            return
+        try:
+            with self.engine.begin() as connection:
+                Table(
+                    f"{self.table_name}{names[self.mode]}",
+                    MetaData(),
+                    schema=self.schema,
+                ).drop(connection, checkfirst=True)
+        except Exception:
+            pass
+
+    def write_batches(self, connection, batches, swaps=None):
+        if isinstance(batches, (pd.DataFrame, pl.DataFrame)):
+            batches = [batches]
+        rows = 0
+        table = None
+        cleared = set()
+        for i, df in enumerate(batches):
+            if isinstance(df, pl.DataFrame):
+                df = df.to_pandas()
+            if i == 0:
+                table = self.create_table(connection, df)
+            if self.mode == "merge":
+                self.merge(connection, table, df)
+            else:
+                if self.mode == "period":
+                    self.delete_periods(connection, table, df, cleared)
+                self.write(connection, df, table.name)
+            rows += len(df)
+        # An empty load swaps in an empty table, as a plain replace would
+        if table is not None and self.mode == "replace":
+            if swaps is None:
+                self.swap(connection, table.name)
+            else:
+                swaps.append(partial(self.swap, connection, table.name))
+        return rows
+
+    def swap(self, connection, shadow):
+        # Two renames and a drop at the end of the load, the only moment the
+        # table is locked
+        old = f"{self.table_name}_old"
+        if inspect(connection).has_table(self.table_name, schema=self.schema):
+            Table(old, MetaData(), schema=self.schema).drop(connection, checkfirst=True)
+            rename_table(connection, self.table_name, old, self.schema)
+            rename_table(connection, shadow, self.table_name, self.schema)
+            Table(old, MetaData(), schema=self.schema).drop(connection)
+        else:
+            rename_table(connection, shadow, self.table_name, self.schema)
+
+
+class BulkCopy:
+
+    # Datetimes in the staging files as "2024-01-31T00:00:00" plus fractions
+    # of this unit, what the database parses. ISO 8601 with the "T" is read
+    # the same whatever the DATEFORMAT of the SQL Server login's language
+    timestamp_format = "%Y-%m-%dT%H:%M:%S"
+    timestamp_unit = "ms"
+
+    def __init__(self, staging_dir=None, server_dir=None):
+        # Bulk load for SQLLoader(bulk=...): each batch is written to a UTF-8
+        # CSV staging file that the database loads in one statement, then the
+        # file is removed. Subclasses implement copy() for their database.
+        # staging_dir: where the files are written (the temp folder by
+        # default). server_dir: that folder as the database server sees it,
+        # e.g. a UNC share when SQL Server runs on another machine.
+        # Empty strings are loaded as NULL.
+        self.staging_dir = staging_dir or tempfile.gettempdir()
+        self.server_dir = server_dir or self.staging_dir
+        os.makedirs(self.staging_dir, exist_ok=True)
+
+    def columns(self, connection, table_name, schema=None):
+        return [
+            col["name"]
+            for col in inspect(connection).get_columns(table_name, schema=schema)
+        ]
+
+    def stage(self, df, columns):
+        # The batch in the table's column order (the file's columns are
+        # matched by position), written by Arrow's CSV writer: nulls and empty
+        # strings as empty fields, booleans as 1/0
+        table = pa.Table.from_pandas(df.reindex(columns=columns), preserve_index=False)
+        for i, field in enumerate(table.schema):
+            col = table.column(i)
+            if pa.types.is_dictionary(col.type):
+                # Categorical columns as their values, then like the others
+                col = col.cast(col.type.value_type)
+            if pa.types.is_timestamp(col.type):
+                col = pc.strftime(
+                    col.cast(pa.timestamp(self.timestamp_unit), safe=False),
+                    format=self.timestamp_format,
+                )
+            elif pa.types.is_boolean(col.type):
+                col = col.cast(pa.int8())
+            elif pa.types.is_string(col.type) or pa.types.is_large_string(col.type):
+                col = pc.if_else(pc.equal(col, ""), None, col)
+            table = table.set_column(i, field.name, col)
+        name = f"{uuid.uuid4().hex}.csv"
+        pa_csv.write_csv(
+            table,
+            os.path.join(self.staging_dir, name),
+            pa_csv.WriteOptions(include_header=False),
+        )
+        return name
+
+    def write(self, connection, df, table_name, schema=None):
+        columns = self.columns(connection, table_name, schema)
+        name = self.stage(df, columns)
+        try:
+            self.copy(connection, name, table_name, schema, columns)
+        finally:
+            os.remove(os.path.join(self.staging_dir, name))
+
+    def copy(self, connection, name, table_name, schema, columns):
+        raise NotImplementedError
+
+
+class SQLServerBulkCopy(BulkCopy):
+
+    def copy(self, connection, name, table_name, schema, columns):
+        # BULK INSERT reads the file on the server, in the load's transaction
+        path = os.path.join(self.server_dir, name).replace("'", "''")
+        connection.exec_driver_sql(
+            f"BULK INSERT {table_sql(connection, table_name, schema)} "
+            f"FROM '{path}' WITH (FORMAT = 'CSV', FIELDQUOTE = '\"', "
+            "FIELDTERMINATOR = ',', ROWTERMINATOR = '0x0a', CODEPAGE = '65001', "
+            "KEEPNULLS, TABLOCK)"
+        )
+
+
+class SQLiteBulkCopy(BulkCopy):
+
+    # SQLAlchemy's storage format for SQLite datetimes ("2024-01-31
+    # 00:00:00.000000"), so period deletes and reads match the rows written
+    # by to_sql
+    timestamp_format = "%Y-%m-%d %H:%M:%S"
+    timestamp_unit = "us"
+
+    def copy(self, connection, name, table_name, schema, columns):
+        # Local stand-in for tests and benchmarks, same staging files: streams
+        # the file into one executemany of the driver, empty fields as NULL
+        placeholders = ", ".join(["NULLIF(?, '')"] * len(columns))
+        cursor = connection.connection.cursor()
+        with open(
+            os.path.join(self.staging_dir, name), newline="", encoding="utf-8"
+        ) as f:
+            cursor.executemany(
+                f"INSERT INTO {table_sql(connection, table_name, schema)} "
+                f"VALUES ({placeholders})",
+                csv.reader(f),
+            )
+        cursor.close()
+
+
+BULK_COPY = {"mssql": SQLServerBulkCopy, "sqlite": SQLiteBulkCopy}
+
+
+def bulk_copy(engine, **kwargs):
+    # The BulkCopy of the engine's database, kwargs as BulkCopy
+    if engine.dialect.name not in BULK_COPY:
+        raise ValueError(f"No bulk load for {engine.dialect.name}")
+    return BULK_COPY[engine.dialect.name](**kwargs)
+
+
+class SQLSink:
+
+    def __init__(self, engine):
+        # Loads of several tables into one database over the pooled
+        # connections of one engine (shared_engine), back to back or from
+        # several threads. Inside transaction() they all go through its
+        # connection, one at a time, and are committed together. The swaps of
+        # mode="replace" wait for that commit too, so the renamed tables are
+        # not locked while the other loads of the transaction run.
+        self.engine = engine
+        self.shared = False
+        self.connection = None
+        self.swaps = []
+        # The loaders of the transaction, to drop their work tables if it is
+        # rolled back
+        self.loaders = []
+        self.lock = threading.Lock()
+
+    @classmethod
+    def sql_server(cls, server, database, user, password, **kwargs):
+        # The shared engine of a SQL Server database, kwargs as shared_engine
+        kwargs.setdefault("fast_executemany", True)
+        url = sql_server_url(server, database, user, password)
+        return cls(shared_engine(url, **kwargs))
+
+    def load(self, table_name, batches, **options):
+        # SQLLoader(engine, table_name, **options).load(batches)
+        loader = SQLLoader(self.engine, table_name, **options)
+        if not self.shared:
+            return loader.load(batches)
+        with self.lock:
+            if self.connection is None:
+                self.connection = self.engine.connect()
+                self.connection.begin()
+            self.loaders.append(loader)
+            return loader.load(batches, self.connection, self.swaps)
+
+    def begin(self):
+        # Loads from here to end() share one transaction, opened by the first
+        self.shared = True
+
+    def end(self, commit=True):
+        connection, self.connection = self.connection, None
+        swaps, self.swaps = self.swaps, []
+        loaders, self.loaders = self.loaders, []
+        self.shared = False
+        if connection is None:
+            return
+        committed = False
+        try:
+            if commit:
+                for swap in swaps:
+                    swap()
+                connection.commit()
+                committed = True
+            else:
+                connection.rollback()
+        finally:
+            connection.close()
+            if not committed:
+                for loader in loaders:
+                    loader.drop_work_tables()
+
+    @contextmanager
+    def transaction(self):
+        # with sink.transaction(): sink.load(...); sink.load(...)
+        # Nothing is committed unless every load in the block succeeds
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.end(commit=False)
+            raise
+        self.end()
+
+
+class ParquetLoader:
+
+    def __init__(
+        self,
+        path,
+        partition_col=None,
+        dictionary_cols=("ClientIdSubId", "StaffID"),
+        mode="replace",
+    ):
+        # Report as a Parquet dataset in the directory `path`, for offline
+        # analysis without SQL Server or re-parsing the Excel files.
+        # partition_col (the report's period_col, e.g. CutOff) gives one
+        # "CutOff=2024-01-31" directory per value. dictionary_cols are stored
+        # dictionary-encoded (categorical when read back).
+        # mode:
+        #   "replace" the whole dataset is replaced by the batches
+        #   "append"  the batches are added as new files
+        #   "period"  the partitions present in the batches are replaced
+        if mode not in ("replace", "append", "period"):
+            raise ValueError(f"Unknown load mode: {mode}")
+        if mode == "period" and not partition_col:
+            raise ValueError('mode="period" needs partition_col')
+        self.path = path
+        self.partition_col = partition_col
+        self.dictionary_cols = dictionary_cols
+        self.mode = mode
+
+    def arrow_table(self, df):
+        if isinstance(df, pl.DataFrame):
+            table = df.to_arrow()
+        else:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        for col in self.dictionary_cols:
+            if col in table.column_names:
+                i = table.column_names.index(col)
+                table = table.set_column(i, col, table[col].dictionary_encode())
+        if self.partition_col and pa.types.is_timestamp(
+            table.schema.field(self.partition_col).type
+        ):
+            # Dates for the directory names, read() gives datetimes back
+            i = table.column_names.index(self.partition_col)
+            table = table.set_column(
+                i, self.partition_col, table[self.partition_col].cast(pa.date32())
+            )
+        return table
+
+    @instrument.timed("load")
+    def load(self, batches):
+        # batches: one DataFrame or any iterable of DataFrames (pandas or
+        # polars), like SQLLoader.load. Everything is written to a staging
+        # directory first and only moved in at the end, so a failed load
+        # leaves the old dataset in place.
+        if isinstance(batches, (pd.DataFrame, pl.DataFrame)):
+            batches = [batches]
+        staging = f"{self.path}.staging"
+        shutil.rmtree(staging, ignore_errors=True)
+        # Unique file names so appended files never overwrite older ones
+        token = uuid.uuid4().hex[:12]
+        rows = 0
+        for i, df in enumerate(batches):
+            table = self.arrow_table(df)
+            partitioning = None
+            if self.partition_col:
+                partitioning = ds.partitioning(
+                    pa.schema([table.schema.field(self.partition_col)]),
+                    flavor="hive",
+                )
+            ds.write_dataset(
+                table,
+                staging,
+                format="parquet",
+                partitioning=partitioning,
+                basename_template=f"part-{token}-{i}-{{i}}.parquet",
+                existing_data_behavior="overwrite_or_ignore",
+            )
+            rows += len(table)
+        if os.path.isdir(staging):
+            self.publish(staging)
+        return rows
+
+    def publish(self, staging):
+        if self.mode == "replace":
+            old = f"{self.path}.old"
+            shutil.rmtree(old, ignore_errors=True)
+            if os.path.isdir(self.path):
+                os.replace(self.path, old)
+            os.replace(staging, self.path)
+            shutil.rmtree(old, ignore_errors=True)
+            return
+        for root, _, files in os.walk(staging):
+            target = os.path.join(self.path, os.path.relpath(root, staging))
+            if self.mode == "period" and root != staging:
+                shutil.rmtree(target, ignore_errors=True)
+            os.makedirs(target, exist_ok=True)
+            for name in files:
+                os.replace(os.path.join(root, name), os.path.join(target, name))
+        shutil.rmtree(staging)
+
+    def read(self):
+        # The dataset as one pandas DataFrame, date partitions as datetimes
+        partitioning = "hive"
+        if self.partition_col:
+            values = [
+                name.split("=", 1)[1]
+                for name in os.listdir(self.path)
+                if name.startswith(f"{self.partition_col}=")
+            ]
+            if values and all(
+                re.fullmatch(r"\d{4}-\d{2}-\d{2}", value) for value in values
+            ):
+                partitioning = ds.partitioning(
+                    pa.schema([(self.partition_col, pa.timestamp("ns"))]),
+                    flavor="hive",
+                )
+        return pd.read_parquet(self.path, partitioning=partitioning)
@@ -0,0 +1,322 @@
+import argparse
+import importlib
+import inspect
+import json
+import os
+import time
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from lib.cache import ParseCache
+from lib.ingest import load_pipelined, shutdown_executors
+from lib.layout import LayoutCache
+from lib.loader import SQLSink, bulk_copy, shared_engine
+from lib.sidecar import SheetSidecars
+
+# Runs every report of a firm from one JSON config, what the "Clean CCH Report
+# and import to SQL" notebook does by hand:
+#   python -m lib.orchestrate firm.json
+# {
+#   "module": "lib.transform",
+#   "sql": {"server": "TOM", "database": "TPS", "user": "TOM",
+#           "password_env": "CCH_SQL_PASSWORD"},
+#   "workers": 4,
+#   "layouts": "layouts.json",
+#   "reports": [
+#     {"report": "WIPARAging", "folder": "...\\WIPAR_Aging",
+#      "table": "WIPARAging"},
+#     {"report": "StaffMonthly", "folder": "...", "table": "StaffMonthly",
+#      "options": {"utcFormat": "Etc/GMT-6"}},
+#     {"report": "StaffList", "file": "...\\StaffList.xlsx",
+#      "table": "StaffList"},
+#     {"report": "excel", "file": "...\\ClientManager.xlsx",
+#      "table": "ClientManager"},
+#     {"report": "StaffPosted", "folder": "...", "table": "StaffPosted_Full",
+#      "mode": "period"}
+#   ]
+# }
+# Several firms in one run: "reports" with folders relative to each firm's
+# root, and per firm whatever differs (usually the database):
+#   "reports": [{"report": "WIPARAging", "folder": "WIPAR_Aging", ...}, ...],
+#   "firms": [
+#     {"name": "TPS", "root": "...\\Source TPS", "sql": {"database": "TPS"}},
+#     {"name": "ACS", "root": "...\\Source ACS",
+#      "sql": {"database": "SSRPA_310492"}}
+#   ]
+# "sql" is either the SQL Server login above ("password" works too) or
+# {"url": "<SQLAlchemy URL>"}, e.g. SQLite for a local run; a report can
+# override it. "workers", "cache" (lib.cache.ParseCache folder), "layouts"
+# (lib.layout.LayoutCache file) and "sidecars" (lib.sidecar.SheetSidecars
+# folder) apply to every report. "mode" is the load mode of SQLLoader, the
+# key_cols and period_col of the report class are used for it. Loads to the
+# same database share one pooled engine (lib.loader.SQLSink); with
+# "transaction": true the reports of a firm are committed together, and only
+# if all of them loaded. "bulk": true (or {"staging_dir": ..., "server_dir":
+# ...}, see lib.loader.BulkCopy) loads through staging files, BULK INSERT on
+# SQL Server.
+# Reports run concurrently, up to "threads" at a time: their files are parsed
+# in the shared process pool while other reports write to SQL, so the I/O of
+# the loads overlaps the parsing. "pipeline": n (a report can override it)
+# also overlaps them within a report: files are written one by one while the
+# next ones are parsed, n parsed batches at most waiting, see
+# lib.ingest.load_pipelined ("batch_rows" splits the files further).
+
+
+def load_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def make_parser(module, job, config):
+    # The report class with the options of the config it accepts
+    cls = getattr(module, job["report"])
+    options = {
+        "workers": config.get("workers"),
+        "cache": ParseCache(config["cache"]) if config.get("cache") else None,
+        "layouts": LayoutCache(config["layouts"]) if config.get("layouts") else None,
+        "sidecars": (
+            SheetSidecars(config["sidecars"]) if config.get("sidecars") else None
+        ),
+        **job.get("options", {}),
+    }
+    if "file" in job:
+        options["file_path"] = job["file"]
+    else:
+        options["folder_path"] = job["folder"]
+    accepted = inspect.signature(cls).parameters
+    return cls(**{key: value for key, value in options.items() if key in accepted})
+
+
+def parse(module, job, config):
+    if job["report"] == "excel":
+        # A plain sheet, e.g. ClientManager
+        return pd.read_excel(job["file"])
+    return make_parser(module, job, config).process_files()
+
+
+def make_sink(sql):
+    # The pooled engine of the database, shared by every report loaded to it
+    if "url" in sql:
+        return SQLSink(shared_engine(sql["url"]))
+    password = sql.get("password") or os.environ[sql["password_env"]]
+    return SQLSink.sql_server(sql["server"], sql["database"], sql["user"], password)
+
+
+def load(df, job, config, cls=None, depth=None, sink=None):
+    # df: a frame, or the batches of iter_batches with a pipeline depth.
+    # sink: the firm's SQLSink in a shared transaction
+    sql = {**config.get("sql", {}), **job.get("sql", {})}
+    mode = job.get("mode", config.get("mode", "replace"))
+    key_cols = job.get("key_cols", getattr(cls, "key_cols", None))
+    period_col = job.get("period_col", getattr(cls, "period_col", None))
+    sink = sink or make_sink(sql)
+    bulk = job.get("bulk", config.get("bulk"))
+    if bulk:
+        bulk = bulk_copy(sink.engine, **(bulk if isinstance(bulk, dict) else {}))
+    load = partial(
+        sink.load,
+        job["table"],
+        mode=mode,
+        key_cols=key_cols,
+        period_col=period_col,
+        bulk=bulk or None,
+    )
+    if depth:
+        return load_pipelined(df, load, depth)
+    return load(df)
+
+
+def run_report(module, job, config, sink=None):
+    # Parse then load one report, timings and the error instead of raising so
+    # the other reports still run
+    result = {"report": job["report"], "table": job["table"], "rows": 0}
+    cls = getattr(module, job["report"], None)
+    depth = job.get("pipeline", config.get("pipeline"))
+    start = time.perf_counter()
+    try:
+        if depth and cls is not None:
+            # Parse and load at the same time, no separate timings
+            batch_rows = job.get("batch_rows", config.get("batch_rows"))
+            batches = make_parser(module, job, config).iter_batches(batch_rows)
+            result["rows"] = load(batches, job, config, cls, depth, sink)
+        else:
+            df = parse(module, job, config)
+            result["parse_seconds"] = time.perf_counter() - start
+            loaded = time.perf_counter()
+            result["rows"] = load(df, job, config, cls, sink=sink)
+            result["load_seconds"] = time.perf_counter() - loaded
+    except Exception as e:
+        message = str(e).splitlines()[0] if str(e) else ""
+        result["error"] = f"{type(e).__name__}: {message}"
+    result["seconds"] = time.perf_counter() - start
+    return result
+
+
+def firm_configs(config):
+    # One config per firm: the top level with the firm's entries on top ("sql"
+    # merged key by key, "reports" replaced). Report folders and files are
+    # relative to the firm's "root". A config without "firms" is one firm.
+    firms = config.get("firms") or [{"name": config.get("name", "")}]
+    shared = {key: value for key, value in config.items() if key != "firms"}
+    for firm in firms:
+        merged = {
+            **shared,
+            **firm,
+            "sql": {**shared.get("sql", {}), **firm.get("sql", {})},
+        }
+        root = merged.get("root", "")
+        merged["reports"] = [
+            {
+                **job,
+                **{
+                    key: os.path.join(root, job[key])
+                    for key in ("folder", "file")
+                    if key in job
+                },
+            }
+            for job in merged["reports"]
+        ]
+        yield merged
+
+
+def failed_report(firm, job, error):
+    # Result of a job that did not get to run
+    return {
+        "firm": firm.get("name", ""),
+        "report": job["report"],
+        "table": job["table"],
+        "rows": 0,
+        "error": error,
+        "seconds": 0,
+    }
+
+
+def run_firm_report(firm, job, sink=None):
+    try:
+        module = importlib.import_module(firm.get("module", "lib.transform"))
+    except Exception as e:
+        return failed_report(firm, job, f"{type(e).__name__}: {e}")
+    result = run_report(module, job, firm, sink)
+    return {"firm": firm.get("name", ""), **result}
+
+
+def open_sink(firm):
+    # The firm's SQLSink with its transaction begun, or the error that stopped
+    # it (e.g. an unset password_env), which fails only that firm's jobs
+    try:
+        sink = make_sink(firm["sql"])
+        sink.begin()
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    return sink, None
+
+
+def run(config):
+    # Every (firm, report) job on one pool of "threads", files parsed in the
+    # one shared process pool of "workers". A failing job only fails itself,
+    # the other reports of its firm and the other firms still run. The jobs
+    # are interleaved (first report of every firm, then the second ...) so
+    # no database gets all the threads at once. Results in that order.
+    firms = list(firm_configs(config))
+    # "transaction": true loads all reports of a firm in one transaction,
+    # committed only if every one of them loaded
+    sinks, sink_errors = zip(
+        *[
+            open_sink(firm) if firm.get("transaction") else (None, None)
+            for firm in firms
+        ]
+    )
+    jobs = []
+    for i in range(max(len(firm["reports"]) for firm in firms)):
+        for n, firm in enumerate(firms):
+            if i < len(firm["reports"]):
+                jobs.append((n, firm["reports"][i]))
+    start = time.perf_counter()
+
+    def run_job(job):
+        n, report = job
+        if sink_errors[n]:
+            return failed_report(firms[n], report, sink_errors[n])
+        return run_firm_report(firms[n], report, sinks[n])
+
+    with ThreadPoolExecutor(max_workers=config.get("threads", 4)) as threads:
+        results = list(threads.map(run_job, jobs))
+    failed = {n for (n, _), result in zip(jobs, results) if "error" in result}
+    for n, sink in enumerate(sinks):
+        if sink is None:
+            continue
+        firm_results = [result for (m, _), result in zip(jobs, results) if m == n]
+        try:
+            sink.end(commit=n not in failed)
+        except Exception as e:
+            # The commit failed, none of the firm's reports are loaded
+            error = f"{type(e).__name__}: {e}"
+        else:
+            if n not in failed:
+                continue
+            # Rolled back, the reports that loaded fine are not in the database
+            tables = [r["table"] for r in firm_results if "error" in r]
+            error = f"rolled back: {', '.join(tables)}"
+        for result in firm_results:
+            result["rows"] = 0
+            result.setdefault("error", error)
+    seconds = time.perf_counter() - start
+    rows = sum(result["rows"] for result in results)
+    total = {
+        "rows": rows,
+        "seconds": seconds,
+        "rows_per_sec": rows / seconds if seconds else 0,
+        "failed": [(r["firm"], r["table"]) for r in results if "error" in r],
+        "firms": {},
+    }
+    for result in results:
+        firm = total["firms"].setdefault(
+            result["firm"], {"rows": 0, "seconds": 0, "reports": 0, "failed": 0}
+        )
+        firm["rows"] += result["rows"]
+        firm["seconds"] += result["seconds"]
+        firm["reports"] += 1
+        firm["failed"] += "error" in result
+    return results, total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the reports of a config")
+    parser.add_argument("config", help="JSON config, see lib/orchestrate.py")
+    parser.add_argument("--threads", type=int, help="reports run at the same time")
+    args = parser.parse_args(argv)
+    config = load_config(args.config)
+    if args.threads:
+        config["threads"] = args.threads
+    try:
+        results, total = run(config)
+    finally:
+        shutdown_executors()
+    for result in results:
+        status = result.get("error", "pipelined")
+        if "load_seconds" in result:
+            status = (
+                f"parse {result['parse_seconds']:.2f}s "
+                f"load {result['load_seconds']:.2f}s"
+            )
+        print(
+            f"{result['firm']:12} {result['table']:20} {result['rows']:>10,} rows "
+            f"{result['seconds']:8.2f}s  {status}"
+        )
+    if len(total["firms"]) > 1:
+        # Seconds of a firm add up its reports, they ran side by side
+        for name, firm in total["firms"].items():
+            print(
+                f"{name:12} {'':20} {firm['rows']:>10,} rows "
+                f"{firm['seconds']:8.2f}s  "
+                f"{firm['reports'] - firm['failed']}/{firm['reports']} reports"
+            )
+    print(
+        f"{'total':33} {total['rows']:>10,} rows {total['seconds']:8.2f}s  "
+        f"{total['rows_per_sec']:,.0f} rows/s"
+    )
+    return 1 if total["failed"] else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
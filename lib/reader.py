@@ -0,0 +1,185 @@
+import posixpath
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+import fastexcel
+import numpy as np
+import openpyxl
+import pandas as pd
+import polars as pl
+from lib import instrument
+
+MAIN_NS = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+REL_NS = "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}"
+PKG_NS = "{http://schemas.openxmlformats.org/package/2006/relationships}"
+CELL_REF = re.compile(r"([A-Z]+)(\d+)")
+
+
+@instrument.timed("read")
+def read_sheet_values(
+    file_path, sheet_index=1, n_cols=None, engine="calamine", sidecars=None
+):
+    # Whole sheet in one pass as a 2-D object array, values[row - 1, col - 1]
+    # is the Excel cell (row, col), None for empty cells. n_cols pads narrow
+    # sheets so fixed column positions (e.g. "T") always exist.
+    # engine="calamine" (fastexcel, the reader behind pl.read_excel) gives the
+    # cells as text; "openpyxl" keeps the Python values in read-only mode.
+    # sidecars (lib.sidecar.SheetSidecars) reads the calamine cells from a
+    # converted copy of the sheet.
+    if engine == "calamine" and sidecars is not None:
+        return sidecars.values(file_path, sheet_index, n_cols)
+    if engine == "calamine":
+        sheet = fastexcel.read_excel(file_path).load_sheet(
+            sheet_index, header_row=None, skip_rows=0, dtypes="string"
+        )
+        columns = sheet.available_columns()
+        # calamine drops leading empty columns, put them back
+        offset = columns[0].absolute_index if columns else 0
+        data = sheet.to_polars().to_numpy()
+        values = np.full(
+            (data.shape[0], max(offset + data.shape[1], n_cols or 0)),
+            None,
+            dtype=object,
+        )
+        values[:, offset : offset + data.shape[1]] = data
+        return values
+    if engine != "openpyxl":
+        raise ValueError(f"Unknown engine: {engine}")
+    wb = openpyxl.load_workbook(file_path, read_only=True)
+    try:
+        rows = list(wb.worksheets[sheet_index].iter_rows(min_row=1, values_only=True))
+    finally:
+        wb.close()
+    width = max([len(row) for row in rows] + [n_cols or 0])
+    values = np.full((len(rows), width), None, dtype=object)
+    for i, row in enumerate(rows):
+        values[i, : len(row)] = row
+    return values
+
+
+@instrument.timed("read")
+def read_sheet_region(file_path, columns, first_row=0, sheet_index=1, sidecars=None):
+    # Only the given columns (Excel positions, 0 is "A") from row first_row
+    # (0 is Excel row 1) down, as a polars frame of text with null for empty
+    # cells, one column per entry of `columns` in that order, named "0", "1"...
+    # calamine still reads the sheet XML, but only these cells become Arrow
+    # columns, so unused columns and the preamble cost no memory. With
+    # sidecars (lib.sidecar.SheetSidecars) the cells come from its copy.
+    if sidecars is not None:
+        return sidecars.region(file_path, columns, first_row, sheet_index)
+    wanted = set(columns)
+    sheet = fastexcel.read_excel(file_path).load_sheet(
+        sheet_index,
+        header_row=None,
+        skip_rows=first_row,
+        use_columns=lambda column: column.absolute_index in wanted,
+        dtypes="string",
+    )
+    df = sheet.to_polars()
+    names = dict(zip([c.absolute_index for c in sheet.selected_columns], df.columns))
+    # Columns calamine does not know (empty before the first used one) are null
+    return df.select(
+        (pl.col(names[col]) if col in names else pl.lit(None, pl.String)).alias(str(i))
+        for i, col in enumerate(columns)
+    )
+
+
+def read_report_region(
+    file_path, columns, first_row=0, sheet_index=1, fill="None", sidecars=None
+):
+    # read_sheet_region as pandas, every cell as Arrow-backed text
+    # (string[pyarrow]) and `fill` for empty cells
+    return (
+        read_sheet_region(file_path, columns, first_row, sheet_index, sidecars)
+        .fill_null(fill)
+        .to_pandas(types_mapper=lambda _: pd.StringDtype("pyarrow"))
+    )
+
+
+def sheet_xml_path(xlsx, sheet_index):
+    # Path in the zip of the sheet at sheet_index (workbook order)
+    sheets = ET.fromstring(xlsx.read("xl/workbook.xml")).find(f"{MAIN_NS}sheets")
+    rel_id = sheets[sheet_index].get(f"{REL_NS}id")
+    rels = ET.fromstring(xlsx.read("xl/_rels/workbook.xml.rels"))
+    target = next(rel.get("Target") for rel in rels if rel.get("Id") == rel_id)
+    if target.startswith("/"):
+        return target[1:]
+    return posixpath.normpath(posixpath.join("xl", target))
+
+
+def string_text(elem):
+    # Text of a shared (<si>) or inline (<is>) string, plain or rich text runs
+    t = elem.find(f"{MAIN_NS}t")
+    if t is not None:
+        return t.text or ""
+    return "".join(r.findtext(f"{MAIN_NS}t", "") for r in elem.iter(f"{MAIN_NS}r"))
+
+
+def shared_strings(xlsx, last):
+    # Shared strings 0..last, the rest of the table is not read
+    strings = []
+    if last < 0:
+        return strings
+    with xlsx.open("xl/sharedStrings.xml") as f:
+        for _, elem in ET.iterparse(f):
+            if elem.tag == f"{MAIN_NS}si":
+                strings.append(string_text(elem))
+                elem.clear()
+                if len(strings) > last:
+                    break
+    return strings
+
+
+@instrument.timed("peek")
+def peek_sheet(file_path, n_rows=20, sheet_index=1, fill=None, sidecars=None):
+    # First n_rows of the sheet as a DataFrame of text, df.iat[row, col] is the
+    # Excel cell (row + 1, col + 1) like read_sheet_region, `fill` for empty
+    # cells. Streams the sheet XML and stops after n_rows (None for the whole
+    # sheet), so it costs next to nothing next to reading the sheet. Numbers
+    # are the stored text, which is
+    # enough to find the layout anchors. sidecars (lib.sidecar.SheetSidecars)
+    # takes them from its copy instead, converting the sheet the first time.
+    if sidecars is not None:
+        return sidecars.peek(file_path, n_rows, sheet_index, fill)
+    cells = {}
+    with zipfile.ZipFile(file_path) as xlsx:
+        with xlsx.open(sheet_xml_path(xlsx, sheet_index)) as f:
+            row = col = -1
+            for event, elem in ET.iterparse(f, events=("start", "end")):
+                if event == "start":
+                    if elem.tag == f"{MAIN_NS}row":
+                        row = int(elem.get("r")) - 1 if elem.get("r") else row + 1
+                        col = -1
+                        if n_rows is not None and row >= n_rows:
+                            break
+                    continue
+                if elem.tag == f"{MAIN_NS}c":
+                    ref = CELL_REF.match(elem.get("r") or "")
+                    col = col + 1 if ref is None else column_index(ref.group(1))
+                    kind = elem.get("t")
+                    if kind == "inlineStr":
+                        cells[row, col] = string_text(elem.find(f"{MAIN_NS}is"))
+                    elif elem.findtext(f"{MAIN_NS}v") is not None:
+                        value = elem.findtext(f"{MAIN_NS}v")
+                        cells[row, col] = int(value) if kind == "s" else value
+                    elem.clear()
+                elif elem.tag == f"{MAIN_NS}row":
+                    elem.clear()
+        # Shared strings are stored as their index until here
+        strings = shared_strings(
+            xlsx, max([v for v in cells.values() if isinstance(v, int)], default=-1)
+        )
+    n = max([r for r, _ in cells], default=-1) + 1
+    width = max([c for _, c in cells], default=-1) + 1
+    values = np.full((n, width), fill, dtype=object)
+    for (r, c), value in cells.items():
+        values[r, c] = strings[value] if isinstance(value, int) else value
+    return pd.DataFrame(values)
+
+
+def column_index(letters):
+    # "A" -> 0, "AB" -> 27
+    col = 0
+    for letter in letters:
+        col = col * 26 + ord(letter) - 64
+    return col - 1
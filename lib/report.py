@@ -0,0 +1,75 @@
+import os
+from functools import partial
+from lib.ingest import concat, iter_batches, list_xlsx_files, parse_files
+from lib.layout import LayoutCache
+from lib.reader import peek_sheet
+
+
+class Report:
+    # What the report classes share. A subclass defines schema, parse_file
+    # (one file to a frame), finalize (the last steps, on all files in
+    # process_files or one in iter_batches) and file_paths
+
+    # Bump when the parsing changes so cached results are not reused
+    parser_version = 0
+    # Natural key and period column of the output, used by incremental loads
+    key_cols = None
+    period_col = None
+    # Output column types, see lib.schema
+    schema = {}
+    workers = None
+
+    def file_paths(self):
+        raise NotImplementedError
+
+    def finisher(self, categories=None):
+        # finalize as process_files and iter_batches call it, with one frame
+        return partial(self.finalize, categories=categories)
+
+    def process_files(self):
+        # Process each file, then the last steps on all of them
+        df_list = parse_files(self, self.file_paths())
+        return self.finisher()(concat(df_list, self.schema))
+
+    def iter_batches(self, batch_rows=None):
+        # process_files one file at a time, see lib.ingest.iter_batches. The
+        # "category" columns of every batch are encoded against one vocabulary
+        # that grows with them (lib.schema.grow_categories)
+        return iter_batches(self, self.file_paths(), self.finisher({}), batch_rows)
+
+
+class FolderReport(Report):
+    # A report over the .xlsx files of a folder. layout_markers are the cells
+    # whose position identifies the layout (lib.layout), header first, and
+    # detect_layout(df) finds them in the top rows of a sheet
+
+    layout_markers = []
+
+    def __init__(
+        self, folder_path, workers=None, cache=None, layouts=None, sidecars=None
+    ):
+        self.folder_path = folder_path
+        self.workers = workers
+        # lib.cache.ParseCache to skip re-parsing unchanged files
+        self.cache = cache
+        # lib.layout.LayoutCache, one with a path is shared with the workers
+        # and kept between runs
+        self.layouts = layouts or LayoutCache()
+        # lib.sidecar.SheetSidecars to read the sheets from converted copies
+        self.sidecars = sidecars
+
+    def file_paths(self):
+        xlsx_files = list_xlsx_files(self.folder_path)
+        return [os.path.join(self.folder_path, file) for file in xlsx_files]
+
+    def peek_layout(self, file_path, fill=None):
+        # Top of the sheet (lib.reader.peek_sheet) and its layout. When a
+        # required marker is not in the first layouts.n_rows rows, peek again
+        # over ten times as many, then the whole sheet, and only fail there
+        for n_rows in (self.layouts.n_rows, self.layouts.n_rows * 10, None):
+            peek = peek_sheet(file_path, n_rows, fill=fill, sidecars=self.sidecars)
+            try:
+                return peek, self.layouts.resolve(self, peek)
+            except ValueError:
+                if n_rows is None:
+                    raise
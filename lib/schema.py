@@ -0,0 +1,115 @@
+import pandas as pd
+import polars as pl
+from lib import instrument
+
+# Column types of the report outputs (the `schema` class attribute):
+#   "text"      string
+#   "category"  string repeated over many rows (ClientIdSubId, StaffID ...),
+#               pandas categorical / polars Categorical, one code per row
+#   "float"     float64
+#   "amount"    float64 from text with thousands separators ("1,234.00")
+#   "datetime"  datetime64
+TYPES = ("text", "category", "float", "amount", "datetime")
+
+
+@instrument.timed("schema")
+def apply_schema(df, schema, default=None, errors="coerce", categories=None):
+    # One typed cast per column of the concatenated frame. Columns missing
+    # from schema get the `default` type (None leaves them as they are).
+    # errors="coerce" turns values that do not parse into NaN/NaT, "raise"
+    # fails on them. Works on pandas and polars frames.
+    # categories: {column: CategoricalDtype} shared by the batches of one
+    # iter_batches, see grow_categories (polars Categoricals already share
+    # one global vocabulary)
+    types = {col: schema.get(col, default) for col in df.columns}
+    for col, kind in types.items():
+        if kind not in TYPES + (None,):
+            raise ValueError(f"Unknown column type for {col}: {kind}")
+    if isinstance(df, pl.DataFrame):
+        return df.with_columns(
+            cast_polars(df[col], kind, errors)
+            for col, kind in types.items()
+            if kind is not None
+        )
+    df = df.copy()
+    for col, kind in types.items():
+        if kind == "category" and categories is not None:
+            df[col] = grow_categories(df[col], col, categories)
+        elif kind is not None:
+            df[col] = cast_pandas(df[col], kind, errors)
+    return df
+
+
+def grow_categories(s, col, categories):
+    # s encoded against categories[col] plus the values it does not have yet,
+    # appended (sorted) so the batches before keep their codes
+    s = s.astype("string[pyarrow]")
+    values = pd.Index(s.dropna().unique())
+    if col in categories:
+        known = categories[col].categories
+        values = known.append(values.difference(known).sort_values())
+    else:
+        values = values.sort_values()
+    categories[col] = pd.CategoricalDtype(values)
+    return s.astype(categories[col])
+
+
+def shared_categories(df_list, schema):
+    # The "category" columns of the files of a report encoded against one
+    # vocabulary (all their values, sorted), so concat keeps the codes as they
+    # are instead of falling back to strings or re-encoding
+    cols = [col for col, kind in schema.items() if kind == "category"]
+    if isinstance(df_list[0], pl.DataFrame):
+        return [
+            df.with_columns(
+                df[col].cast(pl.String).cast(pl.Categorical)
+                for col in cols
+                if col in df.columns
+            )
+            for df in df_list
+        ]
+    dtypes = {}
+    for col in cols:
+        if all(col in df.columns for df in df_list):
+            values = pd.concat(
+                [df[col].dropna().drop_duplicates() for df in df_list]
+            ).astype("string[pyarrow]")
+            dtypes[col] = pd.CategoricalDtype(values.drop_duplicates().sort_values())
+    df_list = [df.copy(deep=False) for df in df_list]
+    for df in df_list:
+        for col, dtype in dtypes.items():
+            df[col] = df[col].astype("string[pyarrow]").astype(dtype)
+    return df_list
+
+
+def cast_pandas(s, kind, errors):
+    if kind == "text":
+        return s.astype("string[pyarrow]")
+    if kind == "category":
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            return s
+        return s.astype("string[pyarrow]").astype("category")
+    if kind == "datetime":
+        if pd.api.types.is_datetime64_any_dtype(s.dtype):
+            return s
+        return pd.to_datetime(s, errors=errors)
+    if kind == "amount":
+        s = s.astype("string[pyarrow]").str.replace(",", "", regex=False)
+    return pd.to_numeric(s, errors=errors).astype("float64")
+
+
+def cast_polars(s, kind, errors):
+    strict = errors == "raise"
+    if kind == "text":
+        return s.cast(pl.String)
+    if kind == "category":
+        if s.dtype == pl.Categorical:
+            return s
+        return s.cast(pl.String).cast(pl.Categorical)
+    if kind == "datetime":
+        if s.dtype == pl.String:
+            return s.str.to_datetime(time_unit="ns", strict=strict)
+        return s
+    if kind == "amount" and s.dtype == pl.String:
+        s = s.str.replace_all(",", "", literal=True)
+    return s.cast(pl.Float64, strict=strict)
@@ -0,0 +1,115 @@
+import hashlib
+import json
+import os
+import threading
+import fastexcel
+import numpy as np
+import pandas as pd
+import polars as pl
+from lib import instrument
+
+# Converted-workbook cache. The first read of a sheet decodes it once (calamine,
+# every cell as text) and stores it as an uncompressed Arrow IPC file, next to
+# the workbook or in cache_dir. Later reads of that sheet, the layout peek
+# included, memory-map the IPC file instead of unzipping and parsing the XML.
+# The cells are the ones lib.reader reads, so the reports give the same output
+# with or without it.
+
+
+class SheetSidecars:
+
+    def __init__(self, cache_dir=None):
+        # cache_dir=None keeps each sidecar next to its workbook
+        # (".Report.xlsx.1.<key>.arrow"), a folder the workers can write to
+        # otherwise
+        self.cache_dir = cache_dir
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def prefix(self, file_path, sheet_index):
+        if self.cache_dir is None:
+            folder, name = os.path.split(os.path.abspath(file_path))
+            return os.path.join(folder, f".{name}.{sheet_index}.")
+        # One flat folder for workbooks from anywhere, named after the path
+        name = hashlib.sha256(os.path.abspath(file_path).encode()).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{name}.{sheet_index}.")
+
+    def path(self, file_path, sheet_index=1):
+        # A changed workbook (size or modification time) gets a new name, the
+        # stale sidecar is removed when the new one is written
+        stat = os.stat(file_path)
+        key = json.dumps([stat.st_size, stat.st_mtime_ns])
+        key = hashlib.sha256(key.encode()).hexdigest()[:16]
+        return f"{self.prefix(file_path, sheet_index)}{key}.arrow"
+
+    def table(self, file_path, sheet_index=1):
+        # The whole sheet as text, column "3" is Excel column D and row 0 is
+        # Excel row 1, null for empty cells
+        path = self.path(file_path, sheet_index)
+        if os.path.exists(path):
+            return pl.read_ipc(path, memory_map=True)
+        df = self.convert(file_path, sheet_index)
+        self.write(path, df)
+        self.remove_stale(file_path, sheet_index, path)
+        return df
+
+    @instrument.timed("convert")
+    def convert(self, file_path, sheet_index):
+        sheet = fastexcel.read_excel(file_path).load_sheet(
+            sheet_index, header_row=None, skip_rows=0, dtypes="string"
+        )
+        df = sheet.to_polars()
+        # calamine drops leading empty columns, put them back
+        names = [str(c.absolute_index) for c in sheet.selected_columns]
+        first = int(names[0]) if names else 0
+        return df.rename(dict(zip(df.columns, names))).select(
+            *[pl.lit(None, pl.String).alias(str(i)) for i in range(first)],
+            *names,
+        )
+
+    def write(self, path, df):
+        # Uncompressed so it can be memory-mapped, tmp + rename so a worker
+        # never maps a half-written file
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        df.write_ipc(tmp, compression="uncompressed")
+        os.replace(tmp, path)
+
+    def remove_stale(self, file_path, sheet_index, path):
+        folder, prefix = os.path.split(self.prefix(file_path, sheet_index))
+        for name in os.listdir(folder):
+            other = os.path.join(folder, name)
+            if name.startswith(prefix) and name.endswith(".arrow") and other != path:
+                os.remove(other)
+
+    def peek(self, file_path, n_rows=20, sheet_index=1, fill=None):
+        # lib.reader.peek_sheet from the sidecar: the first n_rows (None for
+        # all) down to the last row and column used in them
+        top = self.table(file_path, sheet_index)
+        if n_rows is not None:
+            top = top.head(n_rows)
+        used = [col for col in top.columns if top[col].null_count() < top.height]
+        rows = top.select(pl.any_horizontal(pl.all().is_not_null())).to_series()
+        n = rows.arg_true().max() + 1 if rows.any() else 0
+        width = int(used[-1]) + 1 if used else 0
+        # object even when no cell is used (polars gives floats then)
+        values = top.head(n).select(top.columns[:width]).to_numpy().astype(object)
+        if fill is not None:
+            values[pd.isna(values)] = fill
+        return pd.DataFrame(values)
+
+    def values(self, file_path, sheet_index=1, n_cols=None):
+        # lib.reader.read_sheet_values from the sidecar
+        data = self.table(file_path, sheet_index).to_numpy()
+        values = np.full((data.shape[0], max(data.shape[1], n_cols or 0)), None, object)
+        values[:, : data.shape[1]] = data
+        return values
+
+    def region(self, file_path, columns, first_row=0, sheet_index=1):
+        # lib.reader.read_sheet_region from the sidecar
+        df = self.table(file_path, sheet_index).slice(first_row)
+        return df.select(
+            (
+                pl.col(str(col)) if str(col) in df.columns else pl.lit(None, pl.String)
+            ).alias(str(i))
+            for i, col in enumerate(columns)
+        )
@@ -1,96 +1,118 @@
 import pandas as pd
-import urllib.parse
-import sqlalchemy
-from sqlalchemy import create_engine, text
-import openpyxl
 import re
 from datetime import datetime
+from functools import partial
 import pytz
-import os
 import polars as pl
-
-
-class ARBalanceListing:
-
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+import numpy as np
+from lib.anchor import (
+    CUTOFF_LAST_ROW,
+    Anchor,
+    locate,
+    locate_all,
+    titled_cols,
+    cut_at_last,
+)
+from lib import instrument
+from lib.ingest import load_pipelined, parse_files
+from lib.loader import SQLServerBulkCopy, SQLSink
+from lib.reader import read_report_region, read_sheet_values
+from lib.report import FolderReport, Report
+from lib.schema import apply_schema
+
+
+class ARBalanceListing(FolderReport):
+
+    parser_version = 3
+    key_cols = None
+    period_col = None
+    schema = {
+        "ClientIdSubId": "category",
+        "TransactionDate": "datetime",
+        "TransNumber": "text",
+        "AppliedNumber": "text",
+        "Amount": "float",
+    }
+
+    layout_markers = [
+        Anchor("header", "Client ID"),
+    ]
 
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z0-9]", "", col_name)
 
-    def process_files(self):
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
+    def detect_layout(self, df):
+        # Find row contains header
+        row_header, _ = locate(df, [Anchor("header", "Client ID")])["header"]
+        # List all cols name to keep
+        keep_cols = titled_cols(df, row_header, blanks=("None",))
+        return {"row_header": row_header, "keep_cols": keep_cols}
+
+    def parse_file(self, file_path):
+        # Layout from the top of the sheet, then only the columns to keep from
+        # the header row down
+        peek, layout = self.peek_layout(file_path, fill="None")
+        df = read_report_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
         ]
-        df_list = []
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            temp = pl.read_excel(file_path, sheet_id=2)
-            # df = pd.read_excel(file_path, sheet_name=1)
-            df = temp.to_pandas()
-            df = df.astype(str)
-            # Find row contains header
-            found = False
-            for row in df.index:
-                for col_idx in range(df.shape[1]):
-                    if df.iloc[row, col_idx]:
-                        if df.iloc[row, col_idx] == "Client ID":
-                            row_header = row
-                            found = True
-                            break
-                if found:
-                    break
-            # List all cols name to keep
-            keep_cols = []
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row_header, col_idx] != "None":
-                    keep_cols.append(col_idx)
-            found = False
-            df = df.iloc[:, keep_cols]
-
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-            df = df[
-                ((df["ClientID"] != "None") | (df["TransactionDate"] != "None"))
-                & (df["ClientID"] != "Client ID")
-                & (df["ClientID"] != "Grand totals:")
-            ].reset_index(drop=True)
-            df = df.replace(["None", ""], None)
-            df["ClientID"] = df["ClientID"].ffill()
-            df["ClientID"] = df["ClientID"].apply(
-                lambda x: (
-                    x.split()[4] if isinstance(x, str) and len(x.split()) > 4 else None
-                )
-            )
-            df = df[df["TransactionDate"].notna()]
-            df.drop(
-                columns=["ClientName", "ARBalance", "AccountingPeriodDate"],
-                inplace=True,
+        df = df[
+            ((df["ClientID"] != "None") | (df["TransactionDate"] != "None"))
+            & (df["ClientID"] != "Client ID")
+            & (df["ClientID"] != "Grand totals:")
+        ].reset_index(drop=True)
+        df = df.replace(["None", ""], None)
+        df["ClientID"] = df["ClientID"].ffill()
+        df["ClientID"] = df["ClientID"].apply(
+            lambda x: (
+                x.split()[4] if isinstance(x, str) and len(x.split()) > 4 else None
             )
-            df.rename(
-                columns={
-                    "ClientID": "ClientIdSubId",
-                    "Document": "TransNumber",
-                    "AppliedTo": "AppliedNumber",
-                },
-                inplace=True,
-            )
-            df["TransactionDate"] = pd.to_datetime(df["TransactionDate"])
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-        final_df["Amount"] = pd.to_numeric(final_df["Amount"])
-        return final_df
+        )
+        df = df[df["TransactionDate"].notna()]
+        df.drop(
+            columns=["ClientName", "ARBalance", "AccountingPeriodDate"],
+            inplace=True,
+        )
+        df.rename(
+            columns={
+                "ClientID": "ClientIdSubId",
+                "Document": "TransNumber",
+                "AppliedTo": "AppliedNumber",
+            },
+            inplace=True,
+        )
+        return df
+
+    @instrument.timed("finalize")
+    def finalize(self, df, categories=None):
+        return apply_schema(df, self.schema, errors="raise", categories=categories)
+
+
+class StaffPosted(FolderReport):
 
+    parser_version = 3
+    key_cols = None
+    period_col = "end_date"
+    # Every other column is a number
+    schema = {"StaffID": "category", "begin_date": "datetime", "end_date": "datetime"}
 
-class StaffPosted:
+    transaction_dates = re.compile(
+        r"(?s)^For Accounting period dates:.*"
+        r"For Transaction dates:(\d{1,2}/\d{1,2}/\d{4}) - (\d{1,2}/\d{1,2}/\d{4})"
+    )
 
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+    # The period marker is the full pattern, so a file without the transaction
+    # dates never shares the layout of one with them
+    layout_markers = [
+        Anchor("header", "Hours"),
+        Anchor("period", transaction_dates, how="regex"),
+    ]
 
     def substring_after_5th_whitespace(self, txt):
         parts = txt.split(" ", 3)
@@ -101,99 +123,90 @@ class StaffPosted:
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z0-9]", "", col_name)
 
-    def process_files(self):
-        # List to store DataFrames
-        df_list = []
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
+    def detect_layout(self, df):
+        anchors = locate(
+            df,
+            [
+                # Because this cell always before 16 rows
+                Anchor(
+                    "period",
+                    self.transaction_dates,
+                    how="regex",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+                # Find Header row
+                Anchor("header", "Hours"),
+            ],
+        )
+        row_header, _ = anchors["header"]
+        # List all cols name to keep
+        keep_cols = titled_cols(df, row_header, blanks=("",))
+        return {
+            "period": anchors["period"],
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path, fill="")
+        row_period, col_period = layout["period"]
+        match = self.transaction_dates.search(peek.iat[row_period, col_period])
+        if match is None:
+            raise ValueError(f"Transaction dates not found in {file_path}")
+        begin_date, end_date = match.group(1), match.group(2)
+        df = read_report_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            fill="",
+            sidecars=self.sidecars,
+        )
+        # Exclude rows has "Grand Total" to the end
+        df = cut_at_last(df, "Grand Totals:")
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
         ]
+        df.drop(df.index[:1], inplace=True)
+        df["StaffID"] = df["PostedHours"]
+        df["BankedUsedHours"] = df["BankedUsedHours"].apply(
+            lambda x: x.split(" ")[1] if len(x.split(" ")) > 1 else x
+        )
+        df["TypeBankedHrs"] = df["BankedUsedHours"].apply(
+            lambda x: x.split(" ")[0] if len(x.split(" ")) > 1 else None
+        )
+        df = df[df["StaffID"].str[-1:] != ")"]
+        df["StaffID"] = df["StaffID"].apply(
+            lambda x: self.substring_after_5th_whitespace(x)
+        )
+        df["StaffID"] = df["StaffID"].ffill()
+        df = df[df["Hours"] != ""].reset_index(drop=True)
+        df.drop(columns="", inplace=True)
+        df.rename(
+            columns={"BankedUsedHours": "BankedHoursUsed", "Hours": "BillHours"},
+            inplace=True,
+        )
+        df["begin_date"] = datetime.strptime(begin_date, "%m/%d/%Y")
+        df["end_date"] = datetime.strptime(end_date, "%m/%d/%Y")
+        return df
+
+    @instrument.timed("finalize")
+    def finalize(self, df, categories=None):
+        return apply_schema(df, self.schema, default="float", categories=categories)
 
-        # Process each file
-
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            df = pd.read_excel(file_path, sheet_name=1)
-            df = df.astype(str)
-            found = False
-            for row in range(16):  # Because this cell always before 16 rows
-                for col in df.columns:
-                    if df.at[row, col] and isinstance(df.at[row, col], str):
-                        if df.at[row, col][:28] == "For Accounting period dates:":
-                            match = re.search(
-                                r"For Transaction dates:(\d{1,2}/\d{1,2}/\d{4}) - (\d{1,2}/\d{1,2}/\d{4})",
-                                df.at[row, col],
-                            )
-                            if match:
-                                begin_date = match.group(1)
-                                end_date = match.group(2)
-                                found = True
-                                break
-                            else:
-                                print("Transaction dates not found.")
-                if found:
-                    break
-            # Find Header row
-            found = False
-            for row in df.index:
-                for col_idx in range(df.shape[1]):
-                    if df.iloc[row, col_idx]:
-                        if df.iloc[row, col_idx] == "Hours":
-                            row_header = row
-                            found = True
-                            break
-                if found:
-                    break
-
-            # List all cols name to keep
-            keep_cols = []
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row_header, col_idx] != "nan":
-                    keep_cols.append(col_idx)
-            df = df.iloc[:, keep_cols]
-            # Exclude rows has "Grand Total" to the end
-            for row in reversed(df.index):
-                if df.iloc[row, 0] == "Grand Totals:":
-                    df.drop(df.index[row:], inplace=True)
-                    break
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-            df.drop(df.index[: row_header + 1], inplace=True)
-            df["StaffID"] = df["PostedHours"]
-            df["BankedUsedHours"] = df["BankedUsedHours"].apply(
-                lambda x: x.split(" ")[1] if len(x.split(" ")) > 1 else x
-            )
-            df["TypeBankedHrs"] = df["BankedUsedHours"].apply(
-                lambda x: x.split(" ")[0] if len(x.split(" ")) > 1 else None
-            )
-            df = df[df["StaffID"].str[-1:] != ")"]
-            df["StaffID"] = df["StaffID"].apply(
-                lambda x: self.substring_after_5th_whitespace(x)
-            )
-            df["StaffID"] = df["StaffID"].ffill()
-            df = df[df["Hours"] != "nan"].reset_index(drop=True)
-            df.drop(columns="", inplace=True)
-            df.rename(
-                columns={"BankedUsedHours": "BankedHoursUsed", "Hours": "BillHours"},
-                inplace=True,
-            )
-            df["begin_date"] = datetime.strptime(begin_date, "%m/%d/%Y")
-            df["end_date"] = datetime.strptime(end_date, "%m/%d/%Y")
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-        for i in final_df.columns:
-            if i not in ["StaffID", "begin_date", "end_date"]:
-                final_df[i] = pd.to_numeric(final_df[i], errors="coerce")
-        return final_df
 
+class WIPActivity(FolderReport):
 
-class WIPActivity:
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+    parser_version = 3
+    key_cols = ["ClientIdSubId", "CutOffDate"]
+    period_col = "CutOffDate"
+    # Every other column is a number
+    schema = {"ClientIdSubId": "category", "CutOffDate": "datetime"}
+
+    layout_markers = [
+        Anchor("header", "WIP Beg Balance"),
+        Anchor("client", "Client ID Sub ID :", how="prefix"),
+        Anchor("cutoff", "PTD", how="prefix"),
+    ]
 
     def find_date(self, txt):
         dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
@@ -203,362 +216,274 @@ class WIPActivity:
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z0-9]", "", col_name)
 
-    def process_files(self):
-        # List to store DataFrames
-        df_list = []
-
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
-        ]
-        # From here to process each file: This code will be determine what position of special cell in this firm
-        file_path = os.path.join(self.folder_path, xlsx_files[0])
-        temp = pl.read_excel(file_path, sheet_id=2)
-        df = temp.to_pandas()
-        # df = pd.read_excel(file_path, sheet_name=1)
-        df = df.astype(str)
-
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
         # Find row contains header
-        found = False
-        for row in df.index:
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx] == "WIP Beg Balance":
-                        row_header = row
-                        found = True
-                        break
-            if found:
-                break
+        row_header, _ = locate(df, [Anchor("header", "WIP Beg Balance")])["header"]
+        anchors = locate(
+            df,
+            [
+                # Keep ClientIdSubId column
+                Anchor(
+                    "client", "Client ID Sub ID :", how="prefix", first_row=row_header
+                ),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor("cutoff", "PTD", how="prefix", last_row=CUTOFF_LAST_ROW),
+            ],
+        )
         # List all cols name to keep
-        # Keep ClientIdSubId column
-        keep_cols = []
-        found = False
-        for row in range(row_header, df.shape[0]):
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx][:18] == "Client ID Sub ID :":
-                        keep_cols.append(col_idx)
-                        found = True
-                        break
-            if found:
-                break
-        for col_idx in range(df.shape[1]):
-            if (df.iloc[row_header, col_idx] != "None") and (
-                df.iloc[row_header, col_idx] != ""
-            ):
-                keep_cols.append(col_idx)
-        # Determine CutOffDate
-        found = False
-        for row in range(16):  # Because this cell always before 16 rows
-            for col in df.columns:
-                if df.at[row, col] and isinstance(df.at[row, col], str):
-                    if df.at[row, col][:3] == "PTD":
-
-                        row_cutoff, col_cutoff = row, col
-                        found = True
-                        break
-            if found:
-                break
-
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            temp = pl.read_excel(file_path, sheet_id=2)
-            df = temp.to_pandas()
-
-            # df = pd.read_excel(file_path, sheet_name=1)
-            CutOffDate = self.find_date(df.at[row_cutoff, col_cutoff])
-            df = df.astype(str)
-            df = df.iloc[:, keep_cols]
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-
-            df.columns.values[0] = "Type"
-            df["ClientIdSubId"] = df["Type"]
-
-            df = df[
-                (df["Type"] != "None") & (df["Type"] != "RTD") & (df["Type"] != "")
-            ].reset_index(drop=True)
-
-            # Exclude rows has "Grand Total" to the end
-            for row in reversed(df.index):
-                if df.iloc[row, 0] == "Grand Totals":
-                    df.drop(df.index[row:], inplace=True)
-                    break
-
-            df["ClientIdSubId"] = df["ClientIdSubId"].replace(["PTD", ""], None)
-            df["ClientIdSubId"] = df["ClientIdSubId"].ffill()
-            df["ClientIdSubId"] = df["ClientIdSubId"].apply(lambda x: x.split(" ")[5])
-            df["CutOffDate"] = datetime.strptime(CutOffDate, "%m/%d/%Y")
-            df = df[df["Type"] == "PTD"]
-            df = df.drop(columns=["Type", "WIP", "RelievedWIPAdjust"]).reset_index(
-                drop=True
-            )
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-        for i in final_df.columns:
-            if i not in ["ClientIdSubId", "CutOffDate"]:
-                final_df[i] = pd.to_numeric(final_df[i], errors="coerce")
-        return final_df
+        keep_cols = [anchors["client"][1]] + titled_cols(df, row_header)
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path, fill="None")
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        # Only the columns to keep, from the header row down
+        df = read_report_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
+        ]
 
+        df.columns.values[0] = "Type"
+        df["ClientIdSubId"] = df["Type"]
 
-class StaffList:
+        df = df[
+            (df["Type"] != "None") & (df["Type"] != "RTD") & (df["Type"] != "")
+        ].reset_index(drop=True)
 
-    def __init__(self, file_path):
+        # Exclude rows has "Grand Total" to the end
+        df = cut_at_last(df, "Grand Totals")
+
+        df["ClientIdSubId"] = df["ClientIdSubId"].replace(["PTD", ""], None)
+        df["ClientIdSubId"] = df["ClientIdSubId"].ffill()
+        df["ClientIdSubId"] = df["ClientIdSubId"].apply(lambda x: x.split(" ")[5])
+        df["CutOffDate"] = datetime.strptime(CutOffDate, "%m/%d/%Y")
+        df = df[df["Type"] == "PTD"]
+        df = df.drop(columns=["Type", "WIP", "RelievedWIPAdjust"]).reset_index(
+            drop=True
+        )
+        return df
+
+    @instrument.timed("finalize")
+    def finalize(self, df, categories=None):
+        return apply_schema(df, self.schema, default="float", categories=categories)
+
+
+class StaffList(Report):
+
+    parser_version = 2
+    key_cols = ["StaffID"]
+    period_col = None
+    schema = {
+        "StaffID": "category",
+        "ReportName": "text",
+        "StaffNameNull": "text",
+        "StaffOffice": "category",
+        "StaffBU": "category",
+        "StaffDepartment": "category",
+        "ReportingManager": "text",
+        "StaffStatus": "text",
+    }
+
+    def __init__(self, file_path, cache=None, sidecars=None):
         self.file_path = file_path
+        # lib.cache.ParseCache to skip re-parsing an unchanged file
+        self.cache = cache
+        # lib.sidecar.SheetSidecars to read the sheet from a converted copy
+        self.sidecars = sidecars
 
-    def process_files(self):
+    def parse_file(self, file_path):
         # Process each Staff
-        file_path = self.file_path
-        wb = openpyxl.load_workbook(file_path)
-        sheet = wb.worksheets[1]
-        last_row = sheet.max_row
-        D = {}
-
-        # Find last row with "Pay Type:"
-        for row in range(last_row - 6, last_row + 1):
-            cell = sheet[f"C{row}"]
-            if cell.value == "Pay Type:":
-                last_row = row + 1
-                break
-
-        # Find first row with "StaffID"
-        for row in range(1, last_row):
-            if sheet[f"C{row}"].value is not None:
-                if sheet[f"C{row}"].value == "Staff ID":
-                    first_row = row + 1  # First position of StaffID
-                    break
-        # Find first row with "Full Name:"
-        first_range = 0
-        last_range = 0
-        for row in range(1, last_row):
-            if sheet[f"C{row}"].value is not None:
-                if sheet[f"C{row}"].value == "Full Name:":
-                    if first_range == 0 and last_range == 0:
-                        first_range = row
-                    elif first_range != 0 and last_range == 0:
-                        last_range = row
-                    else:
-                        size_range = last_range - first_range
-                        break
-        # Process the data
-        for i in range(1, int((last_row - first_row + 1) / size_range + 1)):
-            StaffID = sheet[f"C{(i-1)*size_range + first_row + 1}"].value
-            ReportName = sheet[f"D{(i-1)*size_range + first_row + 1}"].value
-            StaffNameNull = sheet[f"D{(i-1)*size_range + first_row + 2}"].value
-            StaffOffice = sheet[f"D{(i-1)*size_range + first_row + 4}"].value
-            StaffBU = sheet[f"D{(i-1)*size_range + first_row + 5}"].value
-            StaffDepartment = sheet[f"D{(i-1)*size_range + first_row + 6}"].value
-            ReportingManager = sheet[f"K{(i-1)*size_range + first_row + 5}"].value
-            StaffStatus = sheet[f"O{(i-1)*size_range + first_row + 1}"].value
-            D[i] = [
-                StaffID,
-                ReportName,
-                StaffNameNull,
-                StaffOffice,
-                StaffBU,
-                StaffDepartment,
-                ReportingManager,
-                StaffStatus,
-            ]
+        values = read_sheet_values(file_path, n_cols=15, sidecars=self.sidecars)
+        sheet = pd.DataFrame(values)
+        anchors = locate(
+            sheet,
+            [
+                # Find last row with "Pay Type:"
+                Anchor(
+                    "pay_type",
+                    "Pay Type:",
+                    col=2,
+                    first_row=max(len(values) - 7, 0),
+                    required=False,
+                ),
+                # Find first row with "StaffID"
+                Anchor("staff_id", "Staff ID", col=2),
+            ],
+        )
+        # Excel row numbers
+        last_row = anchors["pay_type"][0] + 2 if anchors["pay_type"] else len(values)
+        first_row = anchors["staff_id"][0] + 2  # First position of StaffID
+        # Rows between two "Full Name:" is the size of a staff block
+        full_names = [
+            row
+            for row, _ in locate_all(sheet, Anchor("full_name", "Full Name:", col=2))
+        ]
+        size_range = full_names[1] - full_names[0]
+
+        # Process the data: every field is at a fixed offset in its block
+        n_staff = int((last_row - first_row + 1) / size_range)
+        starts = first_row - 1 + size_range * np.arange(n_staff)
+        fields = {
+            "StaffID": (1, 2),  # C
+            "ReportName": (1, 3),  # D
+            "StaffNameNull": (2, 3),  # D
+            "StaffOffice": (4, 3),  # D
+            "StaffBU": (5, 3),  # D
+            "StaffDepartment": (6, 3),  # D
+            "ReportingManager": (5, 10),  # K
+            "StaffStatus": (1, 14),  # O
+        }
 
         # Create DataFrame
-        df = pd.DataFrame.from_dict(
-            D,
-            orient="index",
-            columns=[
-                "StaffID",
-                "ReportName",
-                "StaffNameNull",
-                "StaffOffice",
-                "StaffBU",
-                "StaffDepartment",
-                "ReportingManager",
-                "StaffStatus",
-            ],
+        df = pd.DataFrame(
+            {name: values[starts + row, col] for name, (row, col) in fields.items()},
+            index=range(1, n_staff + 1),
         )
         return df
 
+    @instrument.timed("finalize")
+    def finalize(self, df, categories=None):
+        return apply_schema(df, self.schema, categories=categories)
 
-class StaffMonthly:
-
-    def __init__(self, folder_path, utcFormat):
-        self.folder_path = folder_path
-        self.utcFormat = utcFormat
+    def file_paths(self):
+        return [self.file_path]
 
     def process_files(self):
-        # Define timezone and current time based on UTC
-        utc_minus = pytz.timezone(self.utcFormat)
-        current_time_utc_minus = datetime.now(utc_minus).strftime("%Y-%m-%d %H:%M:%S")
-
-        # List to store DataFrames
-        df_list = []
+        # One file, its frame keeps the 1-based index
+        return self.finalize(parse_files(self, self.file_paths())[0])
+
+
+class StaffMonthly(FolderReport):
+
+    parser_version = 2
+    key_cols = ["StaffID", "Type", "CutOff"]
+    period_col = "CutOff"
+    months = [
+        "Jan",
+        "Feb",
+        "Mar",
+        "Apr",
+        "May",
+        "Jun",
+        "Jul",
+        "Aug",
+        "Sep",
+        "Oct",
+        "Nov",
+        "Dec",
+        "Total",
+    ]
+    schema = {
+        "StaffID": "category",
+        "Type": "category",
+        **{month: "amount" for month in months},
+        "RunningTime": "datetime",
+        "CutOff": "datetime",
+    }
+
+    def __init__(self, folder_path, utcFormat, workers=None, cache=None, sidecars=None):
+        # The sheets are read whole, no layout to resolve
+        super().__init__(folder_path, workers, cache, sidecars=sidecars)
+        self.utcFormat = utcFormat
 
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
+    def parse_file(self, file_path):
+        values = read_sheet_values(file_path, n_cols=20, sidecars=self.sidecars)
+        sheet = pd.DataFrame(values)
+        l = [
+            "Production Hours",
+            "Production Amounts",
+            "Billed Hours",
+            "Billed Amounts",
+            "Billed Write +/- Amounts",
         ]
+        anchors = locate(
+            sheet,
+            [
+                # Find last row with "Grand Totals :"
+                Anchor(
+                    "totals",
+                    "Grand Totals",
+                    col=1,
+                    first_row=max(len(values) - 13, 0),
+                    required=False,
+                ),
+                # Find first row with "Staff ID"
+                Anchor("staff", "Staff ID", how="prefix", col=1),
+                # Find first row with value starting with "For the Dates"
+                Anchor("dates", "For the Dates", how="prefix", col=7, last_row=19),
+            ],
+        )
+        # Excel row numbers
+        last_row = anchors["totals"][0] if anchors["totals"] else len(values)
+        first_row = anchors["staff"][0] + 1
+        dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", values[anchors["dates"]])
+        first_date = dates[0] if dates else None
+
+        # Process the data: 6-row staff blocks, StaffID row then 5 metric rows
+        n_staff = int((last_row - first_row) / 6)
+        starts = first_row - 1 + 6 * np.arange(n_staff)
+        staff_rows = starts + 1
+        # Because first staff contain year of report so we exclude first record
+        staff_rows[:1] = first_row - 1
+        metric_rows = (starts[:, None] + 2 + np.arange(5)).ravel()
+        # Columns D, E, F, I, J, K, L, M, N, Q, R, S, T
+        month_cols = [3, 4, 5, 8, 9, 10, 11, 12, 13, 16, 17, 18, 19]
 
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            wb = openpyxl.load_workbook(file_path)
-            sheet = wb.worksheets[1]
-            last_row = sheet.max_row
-            D = {}
-            l = [
-                "Production Hours",
-                "Production Amounts",
-                "Billed Hours",
-                "Billed Amounts",
-                "Billed Write +/- Amounts",
-            ]
-            # Find last row with "Grand Totals :"
-            for row in range(last_row - 12, last_row + 1):
-                cell = sheet[f"B{row}"]
-                if cell.value == "Grand Totals":
-                    last_row = row - 1
-                    break
-
-            # Find first row with "Staff ID"
-            for row in range(1, last_row):
-                if sheet[f"B{row}"].value is not None:
-                    if sheet[f"B{row}"].value[:8] == "Staff ID":
-                        first_row = row
-                        break
-
-            # Find first row with value starting with "For the Dates"
-            for row in range(1, 20):
-                if sheet[f"H{row}"].value is not None:
-                    if sheet[f"H{row}"].value[:13] == "For the Dates":
-                        text = sheet[f"H{row}"].value
-                        dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", text)
-                        first_date = dates[0] if dates else None
-                        break
-
-            # Process the data
-            for i in range(1, int((last_row - first_row) / 6 + 1)):
-                # Because first staff contain year of report so we exclude first record
-                if i == 1:
-                    StaffID = sheet[f"B{first_row}"].value.split(" ")[3]
-                    for j in range(5):
-                        Type = l[j]
-                        Jan = sheet[f"D{first_row + 2 + j}"].value
-                        Feb = sheet[f"E{first_row + 2 + j}"].value
-                        Mar = sheet[f"F{first_row + 2 + j}"].value
-                        Apr = sheet[f"I{first_row + 2 + j}"].value
-                        May = sheet[f"J{first_row + 2 + j}"].value
-                        Jun = sheet[f"K{first_row + 2 + j}"].value
-                        Jul = sheet[f"L{first_row + 2 + j}"].value
-                        Aug = sheet[f"M{first_row + 2 + j}"].value
-                        Sep = sheet[f"N{first_row + 2 + j}"].value
-                        Oct = sheet[f"Q{first_row + 2 + j}"].value
-                        Nov = sheet[f"R{first_row + 2 + j}"].value
-                        Dec = sheet[f"S{first_row + 2 + j}"].value
-                        Total = sheet[f"T{first_row + 2 + j}"].value
-                        D[j + 1] = [
-                            StaffID,
-                            Type,
-                            Jan,
-                            Feb,
-                            Mar,
-                            Apr,
-                            May,
-                            Jun,
-                            Jul,
-                            Aug,
-                            Sep,
-                            Oct,
-                            Nov,
-                            Dec,
-                            Total,
-                        ]
-                else:
-                    StaffID = sheet[f"B{first_row + (i-1) * 6 + 1}"].value.split(" ")[3]
-                    for j in range(5):
-                        Type = l[j]
-                        Jan = sheet[f"D{first_row + (i-1) * 6 + 2 + j}"].value
-                        Feb = sheet[f"E{first_row + (i-1) * 6 + 2 + j}"].value
-                        Mar = sheet[f"F{first_row + (i-1) * 6 + 2 + j}"].value
-                        Apr = sheet[f"I{first_row + (i-1) * 6 + 2 + j}"].value
-                        May = sheet[f"J{first_row + (i-1) * 6 + 2 + j}"].value
-                        Jun = sheet[f"K{first_row + (i-1) * 6 + 2 + j}"].value
-                        Jul = sheet[f"L{first_row + (i-1) * 6 + 2 + j}"].value
-                        Aug = sheet[f"M{first_row + (i-1) * 6 + 2 + j}"].value
-                        Sep = sheet[f"N{first_row + (i-1) * 6 + 2 + j}"].value
-                        Oct = sheet[f"Q{first_row + (i-1) * 6 + 2 + j}"].value
-                        Nov = sheet[f"R{first_row + (i-1) * 6 + 2 + j}"].value
-                        Dec = sheet[f"S{first_row + (i-1) * 6 + 2 + j}"].value
-                        Total = sheet[f"T{first_row + (i-1) * 6 + 2 + j}"].value
-                        D[(i - 1) * 6 + j + 1] = [
-                            StaffID,
-                            Type,
-                            Jan,
-                            Feb,
-                            Mar,
-                            Apr,
-                            May,
-                            Jun,
-                            Jul,
-                            Aug,
-                            Sep,
-                            Oct,
-                            Nov,
-                            Dec,
-                            Total,
-                        ]
-            # Create DataFrame
-            df = pd.DataFrame.from_dict(
-                D,
-                orient="index",
-                columns=[
-                    "StaffID",
-                    "Type",
-                    "Jan",
-                    "Feb",
-                    "Mar",
-                    "Apr",
-                    "May",
-                    "Jun",
-                    "Jul",
-                    "Aug",
-                    "Sep",
-                    "Oct",
-                    "Nov",
-                    "Dec",
-                    "Total",
-                ],
-            )
-            df.fillna(0.0, inplace=True)
-            df["RunningTime"] = current_time_utc_minus
-            df["CutOff"] = datetime.strptime(first_date, "%m/%d/%Y")
+        # Create DataFrame
+        df = pd.DataFrame(values[np.ix_(metric_rows, month_cols)], columns=self.months)
+        df.insert(
+            0,
+            "StaffID",
+            np.repeat([values[row, 1].split(" ")[3] for row in staff_rows], 5),
+        )
+        df.insert(1, "Type", np.tile(l, n_staff))
+        df.fillna(0.0, inplace=True)
+        df["CutOff"] = datetime.strptime(first_date, "%m/%d/%Y")
+        return df
 
-            df_list.append(df)
+    def running_time(self):
+        # Define timezone and current time based on UTC
+        utc_minus = pytz.timezone(self.utcFormat)
+        return datetime.now(utc_minus).strftime("%Y-%m-%d %H:%M:%S")
+
+    @instrument.timed("finalize")
+    def finalize(self, df, running_time, categories=None):
+        # Set after parsing so files loaded from the cache get this run's time
+        df.insert(df.columns.get_loc("CutOff"), "RunningTime", running_time)
+        return apply_schema(df, self.schema, errors="raise", categories=categories)
+
+    def finisher(self, categories=None):
+        # One running time for all the files of a run
+        return partial(
+            self.finalize, running_time=self.running_time(), categories=categories
+        )
 
-        final_df = pd.concat(df_list, ignore_index=True)
-        for i in final_df.columns:
-            if not (i in ["StaffID", "Type", "RunningTime", "CutOff"]):
-                final_df[i] = (
-                    final_df[i]
-                    .astype(str)
-                    .str.replace(",", "", regex=False)
-                    .astype(float)
-                )
-            if i in ["RunningTime", "CutOff"]:
-                final_df[i] = pd.to_datetime(final_df[i])
-        return final_df
 
+class WIPARRecon(FolderReport):
 
-class WIPARRecon:
+    parser_version = 3
+    key_cols = None
+    period_col = "CutOff"
+    # Every other column is a number
+    schema = {"ClientIdSubId": "category", "CutOff": "datetime"}
 
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+    layout_markers = [
+        Anchor("header", "WIP Beg\nBalance"),
+        Anchor("cutoff", "For Accounting period dates:", how="prefix"),
+    ]
 
     def find_date(self, txt):
         dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
@@ -568,90 +493,63 @@ class WIPARRecon:
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z]", "", col_name)
 
-    def process_files(self):
-        # List to store DataFrames
-        df_list = []
-
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        anchors = locate(
+            df,
+            [
+                # Find row contains header
+                Anchor("header", "WIP Beg\nBalance"),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor(
+                    "cutoff",
+                    "For Accounting period dates:",
+                    how="prefix",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+            ],
+        )
+        row_header, _ = anchors["header"]
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        # Determine cols name to keep
+        keep_cols = titled_cols(df, row_header)
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path, fill="None")
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        # Only the columns to keep, from the header row down
+        df = read_report_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
         ]
-        # From here to process each file: This code will be determine what position of special cell in this firm
-        file_path = os.path.join(self.folder_path, xlsx_files[0])
-        # df = pd.read_excel(file_path, sheet_name=1)
-        temp = pl.read_excel(file_path, sheet_id=2)
-        df = temp.to_pandas()
-        df = df.astype(str)
+        df = df.drop(df.index[:1]).reset_index(drop=True)
+        df["ClientIdSubId"] = df["WIPBegBalance"]
+        # Exclude rows has "Grand Total" to the end
+        df = cut_at_last(df, "Grand Totals")
+        # Client rows have exactly 6 words, the last one is the id, every other
+        # row belongs to the client above it
+        df["ClientIdSubId"] = (
+            df["ClientIdSubId"].str.extract(r"^(?:[^ ]* ){5}([^ ]*)$")[0].ffill()
+        )
+        df = df[(df["Hours"] != "None") & (df["Hours"] != "")]
+        df["RealPercent"] = df["RealPercent"].replace("%", "", regex=True)
+        df["CutOff"] = datetime.strptime(CutOffDate, "%m/%d/%Y")
+        return df
 
-        # Find row contains header
-        found = False
-        for row in df.index:
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx] == "WIP Beg\nBalance":
-                        row_header = row
-                        found = True
-                        break
-            if found:
-                break
-        # Determine cols name to keep
-        keep_cols = []
-        for col_idx in range(df.shape[1]):
-            if (df.iloc[row_header, col_idx] != "None") and (
-                df.iloc[row_header, col_idx] != ""
-            ):
-                keep_cols.append(col_idx)
-        # Determine CutOffDate
-        found = False
-
-        for row in range(16):  # Because this cell always before 16 rows
-            for col in df.columns:
-                if df.at[row, col] and isinstance(df.at[row, col], str):
-                    if df.at[row, col][:28] == "For Accounting period dates:":
-                        row_cutoff, col_cutoff = row, col
-                        found = True
-                        break  # Break the inner loop
-            if found:
-                break
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            temp = pl.read_excel(file_path, sheet_id=2)
-            df = temp.to_pandas()
-            # df = pd.read_excel(file_path, sheet_name=1)
-            CutOffDate = self.find_date(df.at[row_cutoff, col_cutoff])
-            df = df.astype(str)
-            df = df.iloc[:, keep_cols]
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-            df = df.drop(df.index[: row_header + 1]).reset_index(drop=True)
-            df["ClientIdSubId"] = df["WIPBegBalance"]
-            # Exclude rows has "Grand Total" to the end
-            for row in reversed(df.index):
-                if df.iloc[row, 0] == "Grand Totals":
-                    df.drop(df.index[row:], inplace=True)
-                    break
-            for row in df.index:
-                if len(df.at[row, "ClientIdSubId"].split(" ")) == 6:
-                    df.at[row, "ClientIdSubId"] = df.at[row, "ClientIdSubId"].split(
-                        " "
-                    )[5]
-                else:
-                    df.at[row, "ClientIdSubId"] = df.at[row - 1, "ClientIdSubId"]
-            df = df[(df["Hours"] != "None") & (df["Hours"] != "")]
-            df["RealPercent"] = df["RealPercent"].replace("%", "", regex=True)
-            df["CutOff"] = datetime.strptime(CutOffDate, "%m/%d/%Y")
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-
-        for i in final_df.columns:
-            if i not in ["CutOff", "ClientIdSubId"]:
-                final_df[i] = pd.to_numeric(final_df[i], errors="coerce")
-        df["CutOff"] = pd.to_datetime(df["CutOff"])
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
         final_df.rename(
             columns={
                 "WIPBegBalance": "WIPBegin",
@@ -665,13 +563,39 @@ class WIPARRecon:
             },
             inplace=True,
         )
-        return final_df
-
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
 
-class WIPARAging:
 
-    def __init__(self, folder_path):
-        self.folder_path = folder_path
+class WIPARAging(FolderReport):
+
+    parser_version = 4
+    key_cols = ["ClientIdSubId", "CutOff"]
+    period_col = "CutOff"
+    # Every other column is a number
+    schema = {
+        "ClientIdSubId": "category",
+        "LastPaymentDate": "datetime",
+        "LastPaymentAmount": "text",
+        "CutOff": "datetime",
+        # AR/WIP of the parsed files, pivoted into the columns by finalize
+        "Type": "category",
+    }
+
+    # First date and first $ amount anywhere in a "Last Payment" cell, as
+    # groups 0 and 1 of one str.extract
+    last_payment = re.compile(
+        r"(?s)^(?=(?:.*?(\d{1,2}/\d{1,2}/\d{4}))?)"
+        r"(?=(?:.*?\$(\d{1,3}(?:,\d{3})*(?:\.\d{2})?))?)"
+    )
+
+    layout_markers = [
+        Anchor("header", "Total"),
+        Anchor("client", "Client ID Sub ID :", how="prefix"),
+        Anchor("type", "AR"),
+        Anchor("cutoff", "For WIP dates as of:", how="prefix"),
+    ]
 
     def find_date(self, txt):
         dates = re.findall(r"\d{1,2}/\d{1,2}/\d{4}", txt)
@@ -681,156 +605,97 @@ class WIPARAging:
     def clean_column_name(self, col_name):
         return re.sub(r"[^a-zA-Z0-9]", "", col_name)
 
-    def get_payment(self, txt):
-        date_match = re.search(r"\d{1,2}/\d{1,2}/\d{4}", txt)
-        amount_match = re.search(r"\$\d{1,3}(?:,\d{3})*(?:\.\d{2})?", txt)
-        LastPaymentDate = date = date_match.group() if date_match else None
-        LastPaymentAmount = (
-            amount_match.group().replace("$", "").replace(",", "")
-            if amount_match
-            else None
+    def detect_layout(self, df):
+        # This code will be determine what position of special cell in this firm
+        # Find row contains header
+        row_header, _ = locate(df, [Anchor("header", "Total")])["header"]
+        anchors = locate(
+            df,
+            [
+                # Keep ClientIdSubId column
+                Anchor(
+                    "client", "Client ID Sub ID :", how="prefix", first_row=row_header
+                ),
+                # Keep type of transaction column
+                Anchor("type", "AR", first_row=row_header),
+                # Determine CutOffDate, because this cell always before 16 rows
+                Anchor(
+                    "cutoff",
+                    "For WIP dates as of:",
+                    how="prefix",
+                    last_row=CUTOFF_LAST_ROW,
+                ),
+            ],
         )
-        return LastPaymentDate, LastPaymentAmount
-
-    def process_files(self):
-        # List to store DataFrames
-        df_list = []
-
-        # Get list of .xlsx files
-        xlsx_files = [
-            f
-            for f in os.listdir(self.folder_path)
-            if f.endswith(".xlsx") and not (f.startswith("~"))
+        # List all cols name to keep, all column has title
+        keep_cols = [anchors["client"][1], anchors["type"][1]] + titled_cols(
+            df, row_header, blanks=("nan",)
+        )
+        row_cutoff, col_cutoff = anchors["cutoff"]
+        return {
+            "row_header": row_header,
+            "keep_cols": keep_cols,
+            "row_cutoff": row_cutoff,
+            "col_cutoff": col_cutoff,
+        }
+
+    def parse_file(self, file_path):
+        peek, layout = self.peek_layout(file_path, fill="None")
+        row_cutoff, col_cutoff = layout["row_cutoff"], layout["col_cutoff"]
+        CutOffDate = self.find_date(peek.iat[row_cutoff, col_cutoff])
+        # Only the columns to keep, from the header row down
+        df = read_report_region(
+            file_path,
+            layout["keep_cols"],
+            layout["row_header"],
+            sidecars=self.sidecars,
+        )
+        df.columns = [
+            self.clean_column_name(df.iloc[0, col]) for col in range(df.shape[1])
         ]
-        # From here to process each file: This code will be determine what position of special cell in this firm
-        file_path = os.path.join(self.folder_path, xlsx_files[0])
-        temp = pl.read_excel(file_path, sheet_id=2)
-        # df = pd.read_excel(file_path, sheet_name=1)
-        df = temp.to_pandas()
-        df = df.astype(str)
+        df.columns.values[0] = "LastPaymentDate"
+        df.columns.values[1] = "Type"
+        df["ClientIdSubId"] = df["LastPaymentDate"]
+        df = df.drop(df.index[:1]).reset_index(drop=True)
+        # Exclude rows has "Grand Total" to the end
+        df = cut_at_last(df, "Grand Totals :")
+        df = df[(df["LastPaymentDate"] != "nan") | (df["Type"] != "nan")]
+        # Sixth word of the "Client ID Sub ID :" rows, filled down below
+        df["ClientIdSubId"] = df["ClientIdSubId"].str.extract(
+            r"^\s*(?:\S+\s+){5}(\S+)"
+        )[0]
+        payment = df["LastPaymentDate"].str.extract(self.last_payment)
+        df["LastPaymentAmount"] = payment[1].str.replace(",", "", regex=False)
+        df["LastPaymentDate"] = payment[0]
+        df["ClientIdSubId"] = df["ClientIdSubId"].ffill()
+        df["LastPaymentAmount"] = df["LastPaymentAmount"].ffill()
+        df["LastPaymentDate"] = df["LastPaymentDate"].ffill()
+        df = df[(df["Type"] == "WIP") | (df["Type"] == "AR")]
+        df.drop(columns=["", "None"], inplace=True)
+        df["CutOffDate"] = datetime.strptime(CutOffDate, "%m/%d/%Y")
+        return df
 
-        # Find row contains header
-        found = False
-        for row in df.index:
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx] == "Total":
-                        row_header = row
-                        found = True
-                        break
-            if found:
-                break
-        # List all cols name to keep
-        # Keep ClientIdSubId column
-        keep_cols = []
-        found = False
-        for row in range(row_header, df.shape[0]):
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx][:18] == "Client ID Sub ID :":
-                        keep_cols.append(col_idx)
-                        found = True
-                        break
-            if found:
-                break
-        # Keep type of transaction column
-        found = False
-        for row in range(row_header, df.shape[0]):
-            for col_idx in range(df.shape[1]):
-                if df.iloc[row, col_idx]:
-                    if df.iloc[row, col_idx][:18] == "AR":
-                        keep_cols.append(col_idx)
-                        found = True
-                        break
-            if found:
-                break
-        # Keep all column has title
-        for col_idx in range(df.shape[1]):
-            if df.iloc[row_header, col_idx] != "nan":
-                keep_cols.append(col_idx)
-
-        # Determine CutOffDate
-        found = False
-        for row in range(16):  # Because this cell always before 16 rows
-            for col in df.columns:
-                if df.at[row, col] and isinstance(df.at[row, col], str):
-                    if df.at[row, col][:20] == "For WIP dates as of:":
-
-                        row_cutoff, col_cutoff = row, col
-                        found = True
-                        break  # Break the inner loop
-            if found:
-                break
-
-        # Process each file
-        for file in xlsx_files:
-            file_path = os.path.join(self.folder_path, file)
-            temp = pl.read_excel(file_path, sheet_id=2)
-            df = temp.to_pandas()
-            # df = pd.read_excel(file_path, sheet_name=1)
-            CutOffDate = self.find_date(df.at[row_cutoff, col_cutoff])
-            df = df.astype(str)
-            df = df.iloc[:, keep_cols]
-            df.columns = [
-                self.clean_column_name(df.iloc[row_header, col])
-                for col in range(df.shape[1])
-            ]
-            df.columns.values[0] = "LastPaymentDate"
-            df.columns.values[1] = "Type"
-            df["ClientIdSubId"] = df["LastPaymentDate"]
-            df["LastPaymentAmount"] = df["LastPaymentDate"]
-            df = df.drop(df.index[: row_header + 1]).reset_index(drop=True)
-            # Exclude rows has "Grand Total" to the end
-            for row in reversed(df.index):
-                if df.iloc[row, 0] == "Grand Totals :":
-                    df.drop(df.index[row:], inplace=True)
-                    break
-            df = df[(df["LastPaymentDate"] != "nan") | (df["Type"] != "nan")]
-            df["ClientIdSubId"] = (
-                df["ClientIdSubId"]
-                .str.split()
-                .apply(lambda x: x[5] if len(x) > 5 else None)
-            )
-            df["LastPaymentAmount"] = df["LastPaymentAmount"].apply(
-                lambda x: self.get_payment(x)[1]
-            )
-            df["LastPaymentDate"] = df["LastPaymentDate"].apply(
-                lambda x: self.get_payment(x)[0]
-            )
-            df["ClientIdSubId"] = df["ClientIdSubId"].ffill()
-            df["LastPaymentAmount"] = df["LastPaymentAmount"].ffill()
-            df["LastPaymentDate"] = df["LastPaymentDate"].ffill()
-            df = df[(df["Type"] == "WIP") | (df["Type"] == "AR")]
-            df.drop(columns=["", "None"], inplace=True)
-            df = df.pivot(index="ClientIdSubId", columns="Type")
-            df = df.reset_index()
-            df.columns = [
-                f"{col[0]}_{col[1]}" if col[1] != "" else col[0] for col in df.columns
-            ]
-            df.drop(
-                columns=["LastPaymentDate_AR", "LastPaymentAmount_AR"], inplace=True
-            )
-            df.rename(
-                columns={
-                    "LastPaymentAmount_WIP": "LastPaymentAmount",
-                    "LastPaymentDate_WIP": "LastPaymentDate",
-                },
-                inplace=True,
-            )
-            df["LastPaymentDate"] = pd.to_datetime(
-                df["LastPaymentDate"], format="%m/%d/%Y"
-            )
-            df["CutOffDate"] = datetime.strptime(CutOffDate, "%m/%d/%Y")
-            df_list.append(df)
-        final_df = pd.concat(df_list, ignore_index=True)
-        for i in final_df.columns:
-            if i not in [
-                "ClientIdSubId",
-                "LastPaymentAmount",
-                "LastPaymentDate",
-                "CutOffDate",
-            ]:
-                final_df[i] = pd.to_numeric(final_df[i], errors="coerce")
+    @instrument.timed("finalize")
+    def finalize(self, final_df, categories=None):
+        # AR and WIP rows of a client side by side, in one reshape
+        final_df = final_df.pivot(index=["ClientIdSubId", "CutOffDate"], columns="Type")
+        final_df.columns = [f"{col[0]}_{col[1]}" for col in final_df.columns]
+        final_df = final_df.reset_index()
+        final_df.drop(
+            columns=["LastPaymentDate_AR", "LastPaymentAmount_AR"], inplace=True
+        )
+        final_df.rename(
+            columns={
+                "LastPaymentAmount_WIP": "LastPaymentAmount",
+                "LastPaymentDate_WIP": "LastPaymentDate",
+            },
+            inplace=True,
+        )
+        final_df["LastPaymentDate"] = pd.to_datetime(
+            final_df["LastPaymentDate"], format="%m/%d/%Y"
+        )
+        # CutOffDate last as before
+        final_df["CutOffDate"] = final_df.pop("CutOffDate")
         final_df = final_df.rename(
             columns={
                 "Total_AR": "ARTotal",
@@ -852,28 +717,69 @@ class WIPARAging:
                 "CutOffDate": "CutOff",
             }
         )
-        return final_df
+        return apply_schema(
+            final_df, self.schema, default="float", categories=categories
+        )
 
 
 class CreateTableInSQLServer:
-    def __init__(self, SQLServerName, DBName, TableName, UserName, PWD, df_data):
-        self.connect_string = urllib.parse.quote_plus(
-            "DRIVER={ODBC Driver 17 for SQL Server};"
-            "Server=" + SQLServerName + ";"
-            "Database=" + DBName + ";"
-            "UID=" + UserName + ";"
-            "PWD=" + PWD + ";"
-        )
+    def __init__(
+        self,
+        SQLServerName,
+        DBName,
+        TableName,
+        UserName,
+        PWD,
+        df_data,
+        chunksize=10000,
+        dtype=None,
+        mode="replace",
+        key_cols=None,
+        period_col=None,
+        pipeline_depth=None,
+        sink=None,
+        bulk_dir=None,
+    ):
+        # lib.loader.SQLSink: one pooled engine per server and database, so the
+        # tables loaded one after another reuse its logged-in connections.
+        # Pass a sink to load in its transaction (sink.transaction()).
+        self.sink = sink or SQLSink.sql_server(SQLServerName, DBName, UserName, PWD)
         self.TableName = TableName
+        # df_data: a DataFrame or a generator of DataFrames (batches)
         self.df_data = df_data
+        self.chunksize = chunksize
+        self.dtype = dtype
+        # mode="period"/"merge" only rewrite the CutOff periods / natural keys
+        # present in df_data, see the key_cols and period_col of each report
+        self.mode = mode
+        self.key_cols = key_cols
+        self.period_col = period_col
+        # With a generator df_data, write in a thread while the next batches
+        # are parsed, at most pipeline_depth waiting (lib.ingest.load_pipelined)
+        self.pipeline_depth = pipeline_depth
+        # A folder shared with the server (e.g. \\TOM\Staging) to load with
+        # BULK INSERT from staging files instead of row inserts
+        self.bulk_dir = bulk_dir
 
     def run(self):
-        engine = create_engine(
-            f"mssql+pyodbc:///?odbc_connect={self.connect_string}",
-            fast_executemany=True,
+        bulk = None
+        if self.bulk_dir:
+            bulk = SQLServerBulkCopy(self.bulk_dir)
+        load = partial(
+            self.sink.load,
+            self.TableName,
+            dtype=self.dtype,
+            chunksize=self.chunksize,
+            mode=self.mode,
+            key_cols=self.key_cols,
+            period_col=self.period_col,
+            bulk=bulk,
         )
-        with engine.connect() as connection:
-            self.df_data.to_sql(
-                self.TableName, connection, index=False, if_exists="replace"
-            )
-            print("OK")
+        if self.pipeline_depth and not isinstance(
+            self.df_data, (pd.DataFrame, pl.DataFrame)
+        ):
+            rows = load_pipelined(self.df_data, load, self.pipeline_depth)
+        else:
+            rows = load(self.df_data)
+        # Rows loaded, for the caller to report
+        return rows